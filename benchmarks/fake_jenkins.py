@@ -0,0 +1,296 @@
+########
+# Copyright (c) 2016 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+############
+
+"""A stand-in jenkins server, serving generated builds of a single job.
+
+Serves the parts of the jenkins API je uses: the jobs list, the builds
+list, build info, test reports (with tree filtering and ranges), console
+logs and progressive console logs. The newest build is always running.
+
+    python benchmarks/fake_jenkins.py --port 8080 --builds 50 --cases 200
+
+Traffic statistics are served from /__stats__ (and reset by /__reset__):
+the number of requests and of response body bytes.
+"""
+
+import argparse
+import json
+import random
+import re
+import threading
+import time
+import urlparse
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+
+JOB = 'system-tests'
+STATUSES = ['PASSED', 'PASSED', 'PASSED', 'FIXED', 'FAILED', 'REGRESSION',
+            'SKIPPED']
+
+
+class Generator(object):
+    """Deterministic, generated builds, test reports and logs"""
+
+    def __init__(self, builds, suites, cases, stdout_size, log_lines):
+        self.builds = builds
+        self.suites = suites
+        self.cases = cases
+        self.stdout_size = stdout_size
+        self.log_lines = log_lines
+        self._stdout = 'x' * stdout_size
+
+    def is_building(self, number):
+        return number == self.builds
+
+    def build(self, number):
+        return {
+            'number': number,
+            'building': self.is_building(number),
+            'result': None if self.is_building(number) else 'SUCCESS',
+            'timestamp': 1500000000000 + number * 60000,
+            'duration': 60000,
+            'actions': [
+                {'causes': [{'shortDescription': 'Started by timer'}]},
+                {'parameters': [
+                    {'name': 'system_tests_branch', 'value': 'master'},
+                    {'name': 'system_tests_descriptor', 'value': 'main'}]}
+            ]
+        }
+
+    def test_report(self, number):
+        rnd = random.Random(number)
+        suites = []
+        for suite_index in range(self.suites):
+            cases = []
+            for case_index in range(self.cases):
+                status = rnd.choice(STATUSES)
+                failed = status in ['FAILED', 'REGRESSION']
+                cases.append({
+                    'name': 'test_{}@param'.format(case_index),
+                    'className': 'tests.suite{}.Test{}'.format(
+                        suite_index, case_index % 10),
+                    'status': status,
+                    'duration': rnd.random() * 10,
+                    'age': 0,
+                    'errorDetails': 'Error{}: connection to host{} failed '
+                                    'after 3 retries'.format(
+                                        case_index % 50, number)
+                                    if failed else None,
+                    'errorStackTrace': 'Traceback ...' if failed else None,
+                    'stdout': self._stdout,
+                    'stderr': ''
+                })
+            suites.append({'name': 'suite{}'.format(suite_index),
+                           'duration': 100.0,
+                           'cases': cases})
+        return {'duration': 1000.0,
+                'failCount': 0,
+                'passCount': 0,
+                'skipCount': 0,
+                'suites': suites}
+
+    def log(self, number):
+        return ''.join('[build {}] line {} of the console log\n'.format(
+            number, line) for line in range(self.log_lines))
+
+
+def filter_report(report, tree):
+    """Apply the tree queries je sends for test reports, e.g.
+    suites[name,cases[name,status]] or
+    suites[cases[stdout]{3,4}]{1,2}
+    """
+    match = re.match(r'^suites\[(.*)\](?:\{(\d+),(\d+)\})?$', tree)
+    if not match:
+        return report
+    suite_tree, suite_start, suite_end = match.groups()
+    case_match = re.search(r'cases\[([^\]]*)\](?:\{(\d+),(\d+)\})?',
+                           suite_tree)
+    case_fields, case_start, case_end = case_match.groups()
+    case_fields = case_fields.split(',')
+    include_name = 'name' in suite_tree[:case_match.start()]
+    suites = report['suites']
+    if suite_start is not None:
+        suites = suites[int(suite_start):int(suite_end)]
+    result = []
+    for suite in suites:
+        cases = suite['cases']
+        if case_start is not None:
+            cases = cases[int(case_start):int(case_end)]
+        filtered = {'cases': [{field: case.get(field)
+                               for field in case_fields}
+                              for case in cases]}
+        if include_name:
+            filtered['name'] = suite['name']
+        result.append(filtered)
+    return {'suites': result}
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are sent together, otherwise delayed ACKs add
+    # ~40ms to responses on keep-alive connections
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self._route({})
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        self._route(urlparse.parse_qs(self.rfile.read(length)))
+
+    def _route(self, data):
+        server = self.server
+        url = urlparse.urlparse(self.path)
+        query = urlparse.parse_qs(url.query)
+        tree = query.get('tree', [''])[0]
+        resource = re.sub('/+', '/', url.path)
+        if resource == '/__stats__':
+            return self._send(json.dumps(server.stats), count=False)
+        if resource == '/__reset__':
+            server.reset_stats()
+            return self._send('{}', count=False)
+        if server.latency:
+            time.sleep(server.latency)
+        generator = server.generator
+        if resource.endswith('/api/json') and '/job/' not in resource:
+            return self._send_json({'jobs': [{'name': JOB}]})
+        match = re.match(r'^.*/job/[^/]+/(\d+)/(.*)$', resource)
+        if not match:
+            if re.match(r'^.*/job/[^/]+/api/json$', resource):
+                return self._send_json(self._builds(tree))
+            return self._send('Not found', code=404)
+        number, rest = int(match.group(1)), match.group(2)
+        if not 0 < number <= generator.builds:
+            return self._send('Not found', code=404)
+        if rest == 'api/json':
+            return self._send_json(generator.build(number))
+        if rest == 'testReport/api/json':
+            if generator.is_building(number):
+                return self._send('Not found', code=404)
+            report = generator.test_report(number)
+            if tree:
+                report = filter_report(report, tree)
+            return self._send_json(report)
+        if rest == 'consoleText':
+            return self._send(generator.log(number))
+        if rest == 'logText/progressiveText':
+            return self._send_progressive(number, data)
+        return self._send('Not found', code=404)
+
+    def _builds(self, tree):
+        generator = self.server.generator
+        builds = [generator.build(number)
+                  for number in range(generator.builds, 0, -1)]
+        match = re.search(r'\{(\d+),(\d*)\}$', tree)
+        if match:
+            end = int(match.group(2)) if match.group(2) else None
+            builds = builds[int(match.group(1)):end]
+        return {'firstBuild': {'number': 1},
+                'lastBuild': {'number': generator.builds},
+                'builds': builds}
+
+    def _send_progressive(self, number, data):
+        # The log of the running build is served a chunk at a time
+        log = self.server.generator.log(number)
+        start = int(data.get('start', ['0'])[0])
+        if self.server.generator.is_building(number):
+            end = min(len(log), start + self.server.progressive_chunk)
+        else:
+            end = len(log)
+        more = self.server.generator.is_building(number) and end < len(log)
+        self._send(log[start:end], headers={
+            'X-Text-Size': str(end),
+            'X-More-Data': 'true' if more else 'false'
+        })
+
+    def _send_json(self, value):
+        self._send(json.dumps(value), headers={
+            'Content-Type': 'application/json'
+        })
+
+    def _send(self, body, code=200, headers=None, count=True):
+        self.send_response(code)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        if count:
+            self.server.count(len(body))
+
+
+class Server(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, address, generator, latency=0,
+                 progressive_chunk=64 * 1024):
+        HTTPServer.__init__(self, address, Handler)
+        self.generator = generator
+        self.latency = latency
+        self.progressive_chunk = progressive_chunk
+        self._lock = threading.Lock()
+        self.stats = None
+        self.reset_stats()
+
+    def count(self, size):
+        with self._lock:
+            self.stats['requests'] += 1
+            self.stats['bytes'] += size
+
+    def reset_stats(self):
+        with self._lock:
+            self.stats = {'requests': 0, 'bytes': 0}
+
+
+def add_arguments(parser):
+    parser.add_argument('--builds', type=int, default=20,
+                        help='Number of builds (the newest one is running)')
+    parser.add_argument('--suites', type=int, default=5,
+                        help='Test suites per build')
+    parser.add_argument('--cases', type=int, default=100,
+                        help='Test cases per suite')
+    parser.add_argument('--stdout-size', type=int, default=1024,
+                        help='Size of each test case stdout, in bytes')
+    parser.add_argument('--log-lines', type=int, default=10000,
+                        help='Lines in each console log')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='Delay of every response, in milliseconds')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=8080)
+    add_arguments(parser)
+    args = parser.parse_args()
+    generator = Generator(builds=args.builds,
+                          suites=args.suites,
+                          cases=args.cases,
+                          stdout_size=args.stdout_size,
+                          log_lines=args.log_lines)
+    server = Server(('127.0.0.1', args.port), generator,
+                    latency=args.latency / 1000.0)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,205 @@
+########
+# Copyright (c) 2016 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+############
+
+"""Run je commands against a fake jenkins server and measure them.
+
+Every scenario runs twice: cold (empty cache and work directory) and warm
+(right after the cold run). For each run the wall time, the number of
+requests and response bytes served by the fake jenkins, and the peak RSS
+of the je process are recorded.
+
+    python benchmarks/harness.py --builds 50 --cases 200 --latency 5
+    python benchmarks/harness.py --scenario analyze --json results.json
+
+je runs in a temporary home directory, so the real configuration and
+cache are not touched.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib2
+
+import fake_jenkins
+
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARKS_DIR)
+
+
+def scenarios(builds):
+    finished = '1-{}'.format(builds - 1)
+    return [
+        ('report', ['report', fake_jenkins.JOB, finished]),
+        ('report-slim', ['report', fake_jenkins.JOB, finished, '--slim']),
+        ('analyze', ['analyze', fake_jenkins.JOB, '1-{}'.format(builds)]),
+        ('logs', ['logs', fake_jenkins.JOB, '1']),
+        ('tail', ['logs', fake_jenkins.JOB, str(builds), '--tail',
+                  '--stdout']),
+    ]
+
+
+class Harness(object):
+
+    def __init__(self, args):
+        self.args = args
+        self.home = tempfile.mkdtemp(prefix='je-benchmark-')
+        self.port = _free_port()
+        self.env = dict(os.environ)
+        self.env['HOME'] = self.home
+        self.env['PYTHONPATH'] = os.pathsep.join(
+            [REPO_DIR] + filter(None, [os.environ.get('PYTHONPATH')]))
+        self.server = None
+
+    def start(self):
+        self.server = subprocess.Popen([
+            sys.executable, os.path.join(BENCHMARKS_DIR, 'fake_jenkins.py'),
+            '--port', str(self.port),
+            '--builds', str(self.args.builds),
+            '--suites', str(self.args.suites),
+            '--cases', str(self.args.cases),
+            '--stdout-size', str(self.args.stdout_size),
+            '--log-lines', str(self.args.log_lines),
+            '--latency', str(self.args.latency)])
+        deadline = time.time() + 10
+        while True:
+            try:
+                self._server_request('__stats__')
+                break
+            except (IOError, OSError):
+                if time.time() > deadline:
+                    raise
+                time.sleep(0.1)
+        self._je(['init',
+                  '--jenkins-username', 'user',
+                  '--jenkins-password', 'password',
+                  '--jenkins-base-url', 'http://127.0.0.1:{}'.format(
+                      self.port),
+                  '--jenkins-system-tests-base', 'benchmark'])
+
+    def stop(self):
+        if self.server:
+            self.server.terminate()
+            self.server.wait()
+        shutil.rmtree(self.home, ignore_errors=True)
+
+    def run(self, name, command):
+        results = []
+        self._je(['clear', '--force'])
+        for run in ['cold', 'warm']:
+            self._server_request('__reset__')
+            wall_time, max_rss, status = self._measure(command)
+            stats = self._server_request('__stats__')
+            results.append({
+                'scenario': name,
+                'run': run,
+                'command': ' '.join(['je'] + command),
+                'wall_time': wall_time,
+                'requests': stats['requests'],
+                'bytes': stats['bytes'],
+                'max_rss': max_rss,
+                'status': status
+            })
+        return results
+
+    def _measure(self, command):
+        with open(os.devnull, 'w') as devnull:
+            start = time.time()
+            process = subprocess.Popen(
+                [sys.executable, '-m', 'je.main'] + command,
+                stdout=devnull, env=self.env)
+            _, status, rusage = os.wait4(process.pid, 0)
+            wall_time = time.time() - start
+        # ru_maxrss is in kilobytes on linux
+        return wall_time, rusage.ru_maxrss * 1024, os.WEXITSTATUS(status)
+
+    def _je(self, command):
+        with open(os.devnull, 'w') as devnull:
+            subprocess.check_call([sys.executable, '-m', 'je.main'] + command,
+                                  stdout=devnull, env=self.env)
+
+    def _server_request(self, resource):
+        response = urllib2.urlopen('http://127.0.0.1:{}/{}'.format(
+            self.port, resource), timeout=5)
+        try:
+            return json.loads(response.read())
+        finally:
+            response.close()
+
+
+def _free_port():
+    sock = socket.socket()
+    try:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+    finally:
+        sock.close()
+
+
+def _format_size(size):
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if size < 1024:
+            return '{:.1f}{}'.format(size, unit)
+        size /= 1024.0
+    return '{:.1f}TB'.format(size)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    fake_jenkins.add_arguments(parser)
+    parser.add_argument('--scenario', action='append',
+                        help='Scenarios to run (default: all of them)')
+    parser.add_argument('--json', help='Write the results to this file')
+    args = parser.parse_args()
+
+    selected = [(name, command) for name, command in scenarios(args.builds)
+                if not args.scenario or name in args.scenario]
+    harness = Harness(args)
+    results = []
+    try:
+        harness.start()
+        print '{:<14}{:<6}{:>10}{:>10}{:>12}{:>12}'.format(
+            'scenario', 'run', 'wall', 'requests', 'bytes', 'peak rss')
+        for name, command in selected:
+            for result in harness.run(name, command):
+                results.append(result)
+                print '{:<14}{:<6}{:>9.2f}s{:>10}{:>12}{:>12}{}'.format(
+                    result['scenario'],
+                    result['run'],
+                    result['wall_time'],
+                    result['requests'],
+                    _format_size(result['bytes']),
+                    _format_size(result['max_rss']),
+                    '' if result['status'] == 0 else
+                    '  (exit status {})'.format(result['status']))
+    finally:
+        harness.stop()
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'parameters': vars(args), 'results': results}, f,
+                      indent=2)
+    if any(result['status'] for result in results):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+########
+# Copyright (c) 2016 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+############
+
+"""Compare the known errors matcher against the plain re.search loop.
+
+    python benchmarks/known_errors.py --patterns 300 --traces 500
+"""
+
+import argparse
+import os
+import random
+import re
+import sys
+import timeit
+
+# Run from a checkout, without je installed
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from je.errors import KnownErrorsMatcher  # noqa
+
+
+def legacy_match(known_errors, stack_trace):
+    possible_causes = []
+    for error in known_errors:
+        search = re.search(error['pattern'], stack_trace)
+        if search:
+            groups = []
+            group_ids = error.get('group_ids', list())
+            try:
+                for group_id in group_ids:
+                    groups.append(search.group(group_id))
+                message = error['message'].format(*groups)
+            except IndexError:
+                continue
+            possible_causes.append(message)
+    return possible_causes
+
+
+def generate_known_errors(count):
+    known_errors = []
+    for i in range(count):
+        known_errors.append({
+            'pattern': r'Error{0}: connection to (\S+) failed after '
+                       r'(\d+) retries'.format(i),
+            'message': 'error {0} on host {{0}} ({{1}} retries)'.format(i),
+            'group_ids': [1, 2]
+        })
+    return known_errors
+
+
+def generate_stack_traces(count, num_errors, seed=0):
+    rnd = random.Random(seed)
+    stack_traces = []
+    for i in range(count):
+        frames = ''.join('  File "module{0}.py", line {1}, in f{0}'.format(
+            j, rnd.randint(1, 500)) for j in range(20))
+        if rnd.random() < 0.3:
+            error = 'Error{0}: connection to host{1} failed after {2} ' \
+                    'retries'.format(rnd.randrange(num_errors), i,
+                                     rnd.randint(1, 9))
+        else:
+            error = 'AssertionError: expected {0}'.format(i)
+        stack_traces.append(u'Traceback: {0}{1}'.format(frames, error))
+    return stack_traces
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--patterns', type=int, default=300)
+    parser.add_argument('--traces', type=int, default=500)
+    parser.add_argument('--repeat', type=int, default=1)
+    args = parser.parse_args()
+
+    known_errors = generate_known_errors(args.patterns)
+    stack_traces = generate_stack_traces(args.traces, args.patterns)
+    matcher = KnownErrorsMatcher(known_errors)
+
+    for stack_trace in stack_traces:
+        expected = legacy_match(known_errors, stack_trace)
+        actual = matcher.match(stack_trace)
+        assert expected == actual, (stack_trace, expected, actual)
+
+    def run_legacy():
+        for stack_trace in stack_traces:
+            legacy_match(known_errors, stack_trace)
+
+    def run_matcher():
+        for stack_trace in stack_traces:
+            matcher.match(stack_trace)
+
+    legacy = min(timeit.repeat(run_legacy, number=1, repeat=args.repeat))
+    compiled = min(timeit.repeat(run_matcher, number=1, repeat=args.repeat))
+    print '{} patterns x {} stack traces'.format(args.patterns, args.traces)
+    print 'legacy loop: {:.3f}s'.format(legacy)
+    print 'matcher:     {:.3f}s ({:.1f}x)'.format(
+        compiled, legacy / compiled)
+
+
+if __name__ == '__main__':
+    main()
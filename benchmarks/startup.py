@@ -0,0 +1,154 @@
+########
+# Copyright (c) 2016 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+############
+
+"""Measure CLI startup and fail if it regresses.
+
+Checks that importing the CLI does not import heavy modules, and measures
+the import time of je.main and the time to first output of every
+subcommand's --help (and of 'je workdir', when je is initialized).
+
+    python benchmarks/startup.py --import-budget 150 --output-budget 400
+
+Exits with a non zero status if any budget (in milliseconds) is exceeded.
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# je is imported from the checkout, by this script and by the processes
+# it measures
+sys.path.insert(0, REPO_DIR)
+ENV = dict(os.environ)
+ENV['PYTHONPATH'] = os.pathsep.join(
+    [REPO_DIR] + filter(None, [os.environ.get('PYTHONPATH')]))
+
+# Modules that only the commands that need them may import
+HEAVY_MODULES = [
+    'requests',
+    'yaml',
+    'path',
+    'pkg_resources',
+    'sqlite3',
+    'multiprocessing',
+    'mmap',
+    'ijson',
+    'je.jenkins',
+    'je.results',
+    'je.errors',
+    'je.session',
+    'je.streaming',
+    'je.stats',
+    'numpy',
+]
+
+IMPORT_SCRIPT = '''
+import sys, time
+start = time.time()
+import je.main
+elapsed = time.time() - start
+print elapsed
+print ' '.join(m for m in sys.argv[1:] if sys.modules.get(m))
+'''
+
+
+def measure_import(repeat):
+    timings = []
+    heavy = set()
+    for _ in range(repeat):
+        output = subprocess.check_output(
+            [sys.executable, '-c', IMPORT_SCRIPT] + HEAVY_MODULES, env=ENV)
+        elapsed, loaded = (output.split('\n') + [''])[:2]
+        timings.append(float(elapsed) * 1000)
+        heavy.update(loaded.split())
+    return min(timings), sorted(heavy)
+
+
+def measure_first_output(args, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.time()
+        process = subprocess.Popen([sys.executable, '-m', 'je.main'] + args,
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE,
+                                   env=ENV)
+        process.stdout.read(1)
+        timings.append((time.time() - start) * 1000)
+        process.communicate()
+    return min(timings)
+
+
+def subcommands():
+    from je import commands
+    names = []
+    for function in commands.app.commands:
+        names.append([getattr(function, 'argh_name', None) or
+                      function.__name__.replace('_', '-')])
+    for function in commands.cache_app.commands:
+        names.append(['cache', getattr(function, 'argh_name', None) or
+                      function.__name__.replace('_', '-')])
+    return names
+
+
+def is_initialized():
+    return os.path.exists(os.path.expanduser('~/.je/config.yaml'))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--import-budget', type=float, default=150,
+                        help='Maximum import time of je.main, in ms')
+    parser.add_argument('--output-budget', type=float, default=400,
+                        help='Maximum time to first output, in ms')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    failures = []
+    import_time, heavy = measure_import(args.repeat)
+    print 'import je.main: {:.1f}ms'.format(import_time)
+    if import_time > args.import_budget:
+        failures.append('import je.main took {:.1f}ms (budget {:.1f}ms)'
+                        .format(import_time, args.import_budget))
+    if heavy:
+        failures.append('import je.main imported {}'.format(
+            ', '.join(heavy)))
+
+    invocations = [['--help']]
+    invocations += [command + ['--help'] for command in subcommands()]
+    if is_initialized():
+        invocations.append(['workdir'])
+    for invocation in invocations:
+        first_output = measure_first_output(invocation, args.repeat)
+        name = 'je {}'.format(' '.join(invocation))
+        print '{:<32}{:.1f}ms'.format(name, first_output)
+        if first_output > args.output_budget:
+            failures.append('{} took {:.1f}ms to first output (budget '
+                            '{:.1f}ms)'.format(name, first_output,
+                                               args.output_budget))
+
+    if failures:
+        print
+        print 'Startup regressed:'
+        for failure in failures:
+            print '  {}'.format(failure)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -14,12 +14,53 @@
 # limitations under the License.
 ############
 
+import atexit
+import contextlib
+import hashlib
 import json
+import os
+import shutil
+import struct
+import tempfile
+import threading
+import time
+import zlib
 
 from je.configuration import configuration
+from je.timings import timings, CACHE_LOAD, CACHE_HITS, CACHE_MISSES
+
+
+RECORD_MAGIC = 'JEC1'
+RECORD_HEADER = struct.Struct('>4sI')
+CHUNK_SIZE = 64 * 1024
+
+# mkstemp creates files readable only by their owner, files are chmod-ed to
+# the permissions a plain open() would have created them with
+_UMASK = os.umask(0)
+os.umask(_UMASK)
 
 
 class Cache(object):
+    """On disk cache of fetched builds and console logs.
+
+    Records (dicts) are stored in a compact binary format: a small header
+    listing the record's top level keys, followed by each value as zlib
+    compressed JSON. This allows loading a single section (e.g. only the
+    `build` part of a build record) without decompressing the rest.
+    Entries written in the older pretty printed `.json` format are still
+    read, and rewritten in the new format on first load.
+
+    An index of all entries (kind, size and last access time) is kept in
+    `index.json`. Whenever the cache grows beyond `cache_max_size` bytes,
+    the least recently used entries are evicted.
+    """
+
+    compression_level = 6
+
+    def __init__(self):
+        self._index = None
+        self._index_dirty = False
+        self._lock = threading.RLock()
 
     @property
     def cache_dir(self):
@@ -29,36 +70,475 @@ class Cache(object):
     def logs_dir(self):
         return self.cache_dir / 'logs'
 
-    def save(self, key, value):
+    def save(self, key, value, kind='build'):
+        self._save_record(key, value, kind=kind)
+
+    def save_stream(self, key, value, name, chunks):
+        """Save a record, one of whose sections is written incrementally
+
+        :param value: A dict of the record's other sections
+        :param name: The name of the incrementally written section
+        :param chunks: An iterable of the section's JSON serialization, in
+                       chunks
+        """
+        fd, stream_path = tempfile.mkstemp(dir=self.cache_dir,
+                                           prefix='.{}.'.format(key))
+        try:
+            compressor = zlib.compressobj(self.compression_level)
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in chunks:
+                    f.write(compressor.compress(chunk))
+                f.write(compressor.flush())
+            self._save_record(key, value, stream=(name, stream_path))
+        finally:
+            os.remove(stream_path)
+
+    def _save_record(self, key, value, kind='build', stream=None):
+        sections = []
+        for name, section_value in sorted(value.items()):
+            data = json.dumps(section_value, separators=(',', ':'))
+            sections.append((name, zlib.compress(data,
+                                                 self.compression_level)))
+        header = [[name, len(data)] for name, data in sections]
+        if stream:
+            stream_name, stream_path = stream
+            header.append([stream_name, os.path.getsize(stream_path)])
+        header = json.dumps(header)
         key_path = self._key_path(key)
-        key_path.write_text(json.dumps(value,
-                                       indent=2,
-                                       sort_keys=True))
+        with self._atomic_file(key_path) as f:
+            f.write(RECORD_HEADER.pack(RECORD_MAGIC, len(header)))
+            f.write(header)
+            for _, data in sections:
+                f.write(data)
+            if stream:
+                with open(stream_path, 'rb') as stream_file:
+                    shutil.copyfileobj(stream_file, f, CHUNK_SIZE)
+        self._track(kind, key, key_path.getsize())
+
+    def exists(self, key):
+        return self._key_path(key).exists() or \
+            self._legacy_key_path(key).exists()
+
+    def save_log_stream(self, key, chunks):
+        """Save a log, written to disk chunk by chunk
 
-    def save_log(self, key, value):
+        :return: The path of the cached log
+        """
         log_path = self._log_path(key)
-        log_path.write_text(value, encoding='utf8')
+        self._write_chunks(log_path, chunks)
+        self._track('log', key, log_path.getsize())
+        return log_path
+
+    def load_partial_log(self, key):
+        """Return the partial log of a running build
+
+        :return: A (path, offset) tuple, where offset is the log offset to
+                 resume fetching the log from, or (None, 0) if there is no
+                 partial log
+        """
+        partial_path = self._partial_log_path(key)
+        state_path = self._partial_state_path(key)
+        if not partial_path.exists() or not state_path.exists():
+            return None, 0
+        try:
+            state = json.loads(state_path.text())
+        except ValueError:
+            return None, 0
+        # Anything appended after the state was last saved (e.g. if the
+        # process was killed in between) is fetched again
+        if partial_path.getsize() != state['size']:
+            with open(partial_path, 'r+b') as f:
+                f.truncate(state['size'])
+        return partial_path, state['offset']
+
+    def append_partial_log(self, key, chunks, offset, complete=False):
+        """Append to the partial log of a running build, chunk by chunk
+
+        :param chunks: An iterable of the appended part of the log
+        :param offset: The log offset following the appended part
+        :param complete: Whether this is the last part of the log, in which
+                         case the partial log becomes the cached log
+        :return: The path of the partial log, or of the cached log if
+                 `complete`
+        """
+        partial_path = self._partial_log_path(key)
+        state_path = self._partial_state_path(key)
+        partial_path.dirname().mkdir_p()
+        with open(partial_path, 'ab') as f:
+            for chunk in chunks:
+                f.write(chunk)
+        if complete:
+            log_path = self._log_path(key)
+            os.rename(partial_path, log_path)
+            state_path.remove_p()
+            self._track('log', key, log_path.getsize())
+            return log_path
+        self._atomic_write(state_path, json.dumps({
+            'offset': offset,
+            'size': partial_path.getsize()
+        }))
+        return partial_path
+
+    def _write_chunks(self, target, chunks):
+        target.dirname().mkdir_p()
+        with self._atomic_file(target) as f:
+            for chunk in chunks:
+                f.write(chunk)
 
     def load(self, key):
         key_path = self._key_path(key)
         if not key_path.exists():
+            value = self._upgrade_legacy(key)
+            if value is None:
+                self.miss()
+            else:
+                self.hit()
+            return value
+        self._touch('build', key)
+        with open(key_path, 'rb') as f:
+            sections = self._read_header(f)
+            return {name: self._read_section(f, length)
+                    for name, length in sections}
+
+    def load_section(self, key, name):
+        """Load a single top level value of a record
+
+        Only the requested section is read and decompressed. As a record
+        is usually read a section at a time, section reads are not counted
+        as cache hits or misses, callers count them with `hit` and `miss`.
+        """
+        key_path = self._key_path(key)
+        if not key_path.exists():
+            record = self._upgrade_legacy(key)
+            return record.get(name) if record else None
+        self._touch('build', key, hit=False)
+        with open(key_path, 'rb') as f:
+            for section_name, length in self._read_header(f):
+                if section_name == name:
+                    return self._read_section(f, length)
+                f.seek(length, os.SEEK_CUR)
+        return None
+
+    def open_section(self, key, name):
+        """Open a single top level value of a record for reading
+
+        :return: A file like object of the section's JSON serialization,
+                 decompressed as it is read, or None if the record or the
+                 section does not exist
+        """
+        key_path = self._key_path(key)
+        if not key_path.exists() and not self._upgrade_legacy(key):
             return None
-        return json.loads(key_path.text())
+        self._touch('build', key, hit=False)
+        f = open(key_path, 'rb')
+        for section_name, length in self._read_header(f):
+            if section_name == name:
+                return _SectionReader(f, length)
+            f.seek(length, os.SEEK_CUR)
+        f.close()
+        return None
 
-    def load_log(self, key):
+    def digest(self, key):
+        """Return a hex digest of a cached record, or None if it is not
+        cached"""
+        key_path = self._key_path(key)
+        if not key_path.exists() and not self._upgrade_legacy(key):
+            return None
+        digest = hashlib.sha1()
+        with open(key_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), ''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def load_log_path(self, key):
+        """Return the path of a cached log, or None if it is not cached"""
         log_path = self._log_path(key)
         if not log_path.exists():
-            return ''
-        return log_path.text(encoding='utf8')
+            self.miss()
+            return None
+        self._touch('log', key)
+        return log_path
 
     def clear(self):
-        self.cache_dir.rmtree_p()
-        self.cache_dir.mkdir()
-        self.logs_dir.mkdir()
+        with self._lock:
+            self.cache_dir.rmtree_p()
+            self.cache_dir.mkdir()
+            self.logs_dir.mkdir()
+            self._index = self._empty_index()
+            self._index_dirty = True
+
+    def stats(self):
+        """Return the cache index statistics
+
+        :return: A dict with the total size and number of entries, the size
+                 of each job's entries, and hit, miss and eviction counts
+        """
+        with self._lock:
+            index = self._load_index()
+            by_job = {}
+            for entry in index['entries'].values():
+                job = entry['key'].rsplit('-', 1)[0]
+                by_job[job] = by_job.get(job, 0) + entry['size']
+            result = dict(index['stats'])
+            result.update({
+                'size': sum(by_job.values()),
+                'entries': len(index['entries']),
+                'max_size': configuration.cache_max_size,
+                'by_job': by_job
+            })
+            return result
+
+    def prune(self, max_size=None):
+        """Reconcile the index with the files on disk and evict least
+        recently used entries until the cache fits in `max_size` bytes
+        (`cache_max_size` by default)
+
+        :return: The number of evicted entries
+        """
+        with self._lock:
+            self._index = self._scan_index(self._load_index())
+            self._index_dirty = True
+            return self._evict(max_size)
+
+    def hit(self):
+        with self._lock:
+            self._load_index()['stats']['hits'] += 1
+            self._index_dirty = True
+        timings.count(CACHE_HITS)
+
+    def miss(self):
+        with self._lock:
+            self._load_index()['stats']['misses'] += 1
+            self._index_dirty = True
+        timings.count(CACHE_MISSES)
+
+    def _track(self, kind, key, size):
+        with self._lock:
+            index = self._load_index()
+            index['entries'][self._entry_name(kind, key)] = {
+                'key': key,
+                'kind': kind,
+                'size': size,
+                'atime': time.time()
+            }
+            self._index_dirty = True
+            self._evict(keep=self._entry_name(kind, key))
+
+    def _touch(self, kind, key, hit=True):
+        with self._lock:
+            index = self._load_index()
+            name = self._entry_name(kind, key)
+            entry = index['entries'].get(name)
+            if entry is None:
+                # Written by a worker process (which doesn't flush the
+                # index), index it now
+                entry = {'key': key, 'kind': kind}
+                try:
+                    entry['size'] = self._entry_path(entry).getsize()
+                except OSError:
+                    entry = None
+                else:
+                    index['entries'][name] = entry
+            if entry:
+                entry['atime'] = time.time()
+            self._index_dirty = True
+        if hit:
+            self.hit()
+
+    def _evict(self, max_size=None, keep=None):
+        if max_size is None:
+            # A configured size of 0 means unlimited, unlike an explicit 0
+            max_size = configuration.cache_max_size or None
+        index = self._load_index()
+        entries = index['entries']
+        total = sum(e['size'] for e in entries.values())
+        if max_size is None or total <= max_size:
+            return 0
+        evicted = 0
+        for name, entry in sorted(entries.items(),
+                                  key=lambda item: item[1]['atime']):
+            if total <= max_size:
+                break
+            if name == keep:
+                continue
+            self._entry_path(entry).remove_p()
+            del entries[name]
+            total -= entry['size']
+            index['stats']['evictions'] += 1
+            index['stats']['evicted_bytes'] += entry['size']
+            evicted += 1
+        self._index_dirty = True
+        return evicted
+
+    def _load_index(self):
+        if self._index is None:
+            index = None
+            if self._index_path.exists():
+                try:
+                    index = json.loads(self._index_path.text())
+                except ValueError:
+                    pass
+            if index is None:
+                index = self._scan_index(self._empty_index())
+                self._index_dirty = True
+            self._index = index
+            atexit.register(self._flush_index)
+        return self._index
+
+    def _flush_index(self):
+        with self._lock:
+            if self._index is None or not self._index_dirty:
+                return
+            if not self.cache_dir.isdir():
+                return
+            self._atomic_write(self._index_path, json.dumps(self._index))
+            self._index_dirty = False
+
+    def _scan_index(self, index):
+        """Drop index entries whose files are gone and add entries for
+        files the index does not know about"""
+        entries = {}
+        for kind, directory, pattern in [('build', self.cache_dir, '*.jec'),
+                                         ('build', self.cache_dir, '*.json'),
+                                         ('log', self.logs_dir, '*.log')]:
+            if not directory.isdir():
+                continue
+            for f in directory.files(pattern):
+                if f == self._index_path:
+                    continue
+                key = f.namebase
+                name = self._entry_name(kind, key)
+                entry = index['entries'].get(name)
+                if entry is None or entry['size'] != f.getsize():
+                    entry = {
+                        'key': key,
+                        'kind': kind,
+                        'size': f.getsize(),
+                        'atime': f.getatime()
+                    }
+                entries[name] = entry
+        index['entries'] = entries
+        return index
+
+    @staticmethod
+    def _empty_index():
+        return {
+            'entries': {},
+            'stats': {
+                'hits': 0,
+                'misses': 0,
+                'evictions': 0,
+                'evicted_bytes': 0
+            }
+        }
+
+    @property
+    def _index_path(self):
+        return self.cache_dir / 'index.json'
+
+    @staticmethod
+    def _entry_name(kind, key):
+        # All records (builds and case details) share one key space
+        return '{}:{}'.format('log' if kind == 'log' else 'build', key)
+
+    def _entry_path(self, entry):
+        if entry['kind'] == 'log':
+            return self._log_path(entry['key'])
+        key_path = self._key_path(entry['key'])
+        if not key_path.exists():
+            return self._legacy_key_path(entry['key'])
+        return key_path
+
+    def _upgrade_legacy(self, key):
+        legacy_path = self._legacy_key_path(key)
+        if not legacy_path.exists():
+            return None
+        value = json.loads(legacy_path.text())
+        self.save(key, value)
+        legacy_path.remove_p()
+        self._touch('build', key, hit=False)
+        return value
+
+    @staticmethod
+    def _read_header(f):
+        magic, header_length = RECORD_HEADER.unpack(
+            f.read(RECORD_HEADER.size))
+        if magic != RECORD_MAGIC:
+            raise ValueError('Invalid cache record: {}'.format(f.name))
+        return json.loads(f.read(header_length))
+
+    @staticmethod
+    def _read_section(f, length):
+        with timings.phase(CACHE_LOAD):
+            return json.loads(zlib.decompress(f.read(length)))
+
+    def _atomic_write(self, target, data):
+        with self._atomic_file(target) as f:
+            f.write(data)
+
+    @staticmethod
+    @contextlib.contextmanager
+    def _atomic_file(target):
+        fd, tmp_path = tempfile.mkstemp(dir=target.dirname(),
+                                        prefix='.{}.'.format(target.name))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                yield f
+            os.chmod(tmp_path, 0o666 & ~_UMASK)
+            os.rename(tmp_path, target)
+        except:
+            os.remove(tmp_path)
+            raise
 
     def _log_path(self, key):
         return self.logs_dir / '{}.log'.format(key)
 
+    def _partial_log_path(self, key):
+        return self.logs_dir / '{}.partial'.format(key)
+
+    def _partial_state_path(self, key):
+        return self.logs_dir / '{}.partial.json'.format(key)
+
     def _key_path(self, key):
+        return self.cache_dir / '{}.jec'.format(key)
+
+    def _legacy_key_path(self, key):
         return self.cache_dir / '{}.json'.format(key)
+
+
+class _SectionReader(object):
+    """A file like object reading a zlib compressed section of a record,
+    decompressing it as it is read"""
+
+    def __init__(self, f, length):
+        self._f = f
+        self._remaining = length
+        self._decompressor = zlib.decompressobj()
+        self._buffer = ''
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) < size:
+            data = self._decompressor.unconsumed_tail
+            if not data:
+                if not self._remaining:
+                    break
+                data = self._f.read(min(CHUNK_SIZE, self._remaining))
+                if not data:
+                    break
+                self._remaining -= len(data)
+            self._buffer += self._decompressor.decompress(data, CHUNK_SIZE)
+        if size < 0:
+            result, self._buffer = self._buffer, ''
+        else:
+            result, self._buffer = self._buffer[:size], self._buffer[size:]
+        return result
+
+    def close(self):
+        self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
 cache = Cache()
@@ -14,26 +14,35 @@
 # limitations under the License.
 ############
 
+# Commands are imported on every invocation, including shell completion.
+# Modules that are slow to import (requests, yaml, sqlite3, ...) are only
+# imported by the commands that use them, see benchmarks/startup.py
+
 import argparse
 import datetime
+import hashlib
+import os
+import re
+import shutil
+import signal
 import sys
+from StringIO import StringIO
 
-import yaml
 import colors
 import argh
 from argh.decorators import arg
-from path import path
 
-from je.errors import handle_failure
-from je.jenkins import jenkins
 from je.cache import cache
 from je.configuration import configuration
 from je.completion import completion
 from je.work import work
+from je.writer import ReportWriter, is_up_to_date, LAYOUTS, CASES
 
 
 app = argh.EntryPoint('je')
 command = app
+cache_app = argh.EntryPoint('je cache')
+cache_command = cache_app
 
 
 @command
@@ -61,16 +70,23 @@ def init(jenkins_username=None,
 
 @command
 def list_jobs():
+    from je.jenkins import jenkins
     jobs = jenkins.list_jobs()
     for job in jobs['jobs']:
         print job.get('name')
+    completion.save_jobs([job.get('name') for job in jobs['jobs']])
 
 
 @command
 @argh.named('list')
 @arg('job', completer=completion.job_completer)
-def ls(job):
-    builds = jenkins.list_builds(job)
+@arg('--limit', type=int, help='List only this many of the newest builds')
+@arg('--offset', type=int, help='Skip this many of the newest builds')
+def ls(job, limit=None, offset=0):
+    from je.jenkins import jenkins
+    builds = list(jenkins.list_builds(job, limit=limit, offset=offset))
+    if limit is None and not offset:
+        completion.save_builds(job, [build['number'] for build in builds])
     for build in builds:
         result = build['result']
         building = build['building']
@@ -97,48 +113,145 @@ def ls(job):
 @arg('builds',
      completer=completion.build_completer,
      nargs=argparse.ONE_OR_MORE)
-def report(job, builds, failed=False):
-    builds = _fetch_builds(job, builds)
-    num_builds = len(builds)
+@arg('--layout', choices=LAYOUTS, help='Report files layout: a file per '
+                                       'case, or a file per suite')
+@arg('--processes', type=int, help='Render builds in this many processes, '
+                                   'printing each build once it is rendered')
+def report(job, builds, failed=False, jobs=4, slim=False, layout=CASES,
+           processes=None):
+    from je.jenkins import REPORT, FULL
+    multiple_builds = len(_parse_build_numbers(builds)) > 1
+    # In slim mode, stdout, stderr and stack traces are only fetched for
+    # failed cases, when their report file is written
+    fields = REPORT if slim else FULL
+    builds = _fetch_builds(job, builds, jobs=jobs, fields=fields,
+                           load=not processes,
+                           raise_single=not multiple_builds)
+    if processes:
+        builds = _render_builds(job, builds, failed, layout, fields,
+                                processes)
     for index, (build_number, build) in enumerate(builds):
-        if num_builds > 1:
-            print '{0} {1}-{2} {0}'.format('=' * 30, job, build_number)
-        _build_report(job, build, build_number, failed)
-        if index < num_builds - 1:
+        if index > 0:
             print
-
-
-def _build_report(job, build, build_number, failed):
+        if multiple_builds:
+            print '{0} {1}-{2} {0}'.format('=' * 30, job, build_number)
+        if processes:
+            # Already rendered by a worker process
+            sys.stdout.write(build)
+        else:
+            _build_report(job, build, build_number, failed, layout)
+
+
+def _render_builds(job, builds, failed, layout, fields, processes):
+    """Render build reports in a pool of worker processes
+
+    :param builds: (build number, running build or None) pairs, as returned
+                   by `_fetch_builds(..., load=False)`
+    :return: An iterator of (build number, report output) pairs, in build
+             order
+    """
+    from multiprocessing import Pool
+    from je.errors import load_known_errors
+    tasks = [(job, build_number, running_build, failed, layout, fields)
+             for build_number, running_build in builds]
+    # Loaded before forking, so the workers inherit the list instead of
+    # each fetching the gist
+    load_known_errors()
+    pool = Pool(processes, initializer=_init_render_worker)
+    try:
+        rendered = pool.imap(_render_build, tasks)
+        for _ in tasks:
+            # A timeout keeps the main thread responsive to
+            # KeyboardInterrupt
+            yield rendered.next(sys.maxint)
+    finally:
+        pool.terminate()
+
+
+def _init_render_worker():
+    from je.results import results
+    from je.session import session
+    # Interrupts are handled by the parent, which terminates the pool
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    session.reset()
+    results.reset()
+
+
+def _render_build(args):
+    """Render the report of a build, in a worker process
+
+    :return: A (build number, report output) tuple
+    """
+    from je.jenkins import jenkins
+    job, build_number, running_build, failed, layout, fields = args
+    build = running_build or jenkins.fetch_build(job, build_number,
+                                                 stream=True, fields=fields)
+    output = StringIO()
+    _build_report(job, build, build_number, failed, layout, output)
+    return build_number, output.getvalue()
+
+
+def _build_report(job, build, build_number, failed, layout=CASES,
+                  stream=None):
+    import yaml
+    stream = stream or sys.stdout
     report = build['test_report']
     build = build['build']
     if build.get('building'):
         return 'Building is currently running'
     if report.get('status') == 'error':
         return 'No tests report has been generated for this build'
-    failed_dir = work.failed_dir(job, build_number)
-    passed_dir = work.passed_dir(job, build_number)
-    for d in [passed_dir, failed_dir]:
-        d.rmtree_p()
-        d.mkdir()
+    build_dir = work.build_dir(job, build_number)
+    report_hash = _report_hash(job, build_number)
+    # Report files of a build are only rewritten when its cached report
+    # (or the known errors list) changed since they were last written
+    writer = None
+    if not is_up_to_date(build_dir, report_hash, layout):
+        writer = ReportWriter(build_dir, report_hash, layout)
     build_parameters = _extract_build_parameters(build)
     interesting_parameters = ['system_tests_branch', 'system_tests_descriptor']
     interesting_parameters = {k: v for k, v in build_parameters.items()
                               if k in interesting_parameters}
     cause = _extract_build_cause(build)
     timestamp = build['timestamp']
-    print '{}: {} ({})'.format(colors.bold('Cause'),
-                               cause,
-                               _timestamp_to_datetime(timestamp))
-    print
-    print colors.bold('Parameters: ')
-    print yaml.safe_dump(interesting_parameters, default_flow_style=False)
+    print >> stream, '{}: {} ({})'.format(colors.bold('Cause'),
+                                          cause,
+                                          _timestamp_to_datetime(timestamp))
+    print >> stream
+    print >> stream, colors.bold('Parameters: ')
+    print >> stream, yaml.safe_dump(interesting_parameters,
+                                    default_flow_style=False)
+    try:
+        _report_suites(job, build_number, report, failed, writer, stream)
+    except BaseException:
+        if writer is not None:
+            writer.abort()
+        raise
+    if writer is not None:
+        writer.close()
+    print >> stream, 'Report files written to {}'.format(build_dir)
+
+
+def _report_suites(job, build_number, report, failed, writer, stream):
+    from je.errors import handle_failure
+    from je.jenkins import jenkins
     colored_cause = colors.blue(' - CAUSE')
-    for suite in report['suites']:
+    for suite_index, suite in enumerate(report['suites']):
         suite_name = suite['name']
         cases = []
         has_passed = False
         has_failed = False
-        for case in suite['cases']:
+        details = {}
+        if writer is not None:
+            # Slim reports don't include the heavy fields, fetch them only
+            # for the cases that are written to failed/
+            slim_indices = [index for index, case in enumerate(suite['cases'])
+                            if case['status'] not in ['PASSED', 'FIXED'] and
+                            'stdout' not in case]
+            if slim_indices:
+                details = jenkins.fetch_cases_details(
+                    job, build_number, suite_index, slim_indices)
+        for case_index, case in enumerate(suite['cases']):
             test_status = case['status']
             if test_status in ['FAILED', 'REGRESSION']:
                 test_status = 'FAILED'
@@ -161,24 +274,17 @@ def _build_report(job, build, build_number, failed):
                 cases.append('{:<18}{}'.format(
                     colored_status,
                     name.split('@')[0].strip()))
+            causes = StringIO()
+            if has_failed:
+                handle_failure(cases, case, colored_cause, causes)
+            if writer is None:
+                continue
             filename = '{}.log'.format(name.replace(' ', '-'))
-            dirname = passed_dir if test_status == 'PASSED' else failed_dir
-            with open(dirname / filename, 'w') as f:
-                f.write('name: {}\n\n'.format(case['name']))
-                f.write('status: {}\n\n'.format(case['status']))
-
-                if has_failed:
-                    handle_failure(cases, case, colored_cause, f)
-
-                f.write('class: {}\n\n'.format(case['className']))
-                f.write('duration: {}\n\n'.format(case['duration']))
-                f.write('error details: {}\n\n'.format(case['errorDetails']))
-                f.write('error stacktrace: {}\n\n'.format(
-                    case['errorStackTrace']))
-                f.write('stdout: \n{}\n\n'.format(
-                    (case['stdout'] or '').encode('utf-8', errors='ignore')))
-                f.write('stderr: \n{}\n\n'.format(
-                    (case['stderr'] or '').encode('utf-8', errors='ignore')))
+            status_dir = 'passed' if test_status == 'PASSED' else 'failed'
+            if case_index in details:
+                case = dict(case, **details[case_index])
+            writer.add(suite_name, status_dir, filename,
+                       _case_log(case, causes.getvalue()))
         if has_passed and has_failed:
             suite_name_color = colors.yellow
         elif has_passed:
@@ -188,12 +294,35 @@ def _build_report(job, build, build_number, failed):
         else:
             suite_name_color = colors.white
         if cases:
-            print suite_name_color(colors.bold(suite_name))
-            print suite_name_color(colors.bold('-' * (len(suite_name))))
-            print '\n'.join(cases)
-            print
-    print 'Report files written to {}'.format(work.build_dir(job,
-                                                             build_number))
+            print >> stream, suite_name_color(colors.bold(suite_name))
+            print >> stream, suite_name_color(
+                colors.bold('-' * (len(suite_name))))
+            print >> stream, '\n'.join(cases)
+            print >> stream
+
+
+def _case_log(case, causes):
+    return ''.join([
+        'name: {}\n\n'.format(case['name']),
+        'status: {}\n\n'.format(case['status']),
+        causes,
+        'class: {}\n\n'.format(case['className']),
+        'duration: {}\n\n'.format(case['duration']),
+        'error details: {}\n\n'.format(case['errorDetails']),
+        'error stacktrace: {}\n\n'.format(case.get('errorStackTrace')),
+        'stdout: \n{}\n\n'.format(
+            (case.get('stdout') or '').encode('utf-8', errors='ignore')),
+        'stderr: \n{}\n\n'.format(
+            (case.get('stderr') or '').encode('utf-8', errors='ignore'))
+    ])
+
+
+def _report_hash(job, build_number):
+    from je.errors import known_errors_digest
+    digest = hashlib.sha1()
+    digest.update(cache.digest('{}-{}'.format(job, build_number)) or '')
+    digest.update(known_errors_digest() or '')
+    return digest.hexdigest()
 
 
 @command
@@ -201,46 +330,67 @@ def _build_report(job, build, build_number, failed):
 @arg('builds',
      completer=completion.build_completer,
      nargs=argparse.ONE_OR_MORE)
-def analyze(job, builds, passed_at_least_once=False, failed=False):
-    builds = _fetch_builds(job, builds)
-    report = {}
-    for build_number, build in builds:
+@arg('--stats', help='Show flakiness statistics of the cases instead of '
+                     'their status counts (requires numpy)')
+def analyze(job, builds, passed_at_least_once=False, failed=False,
+            jobs=4, stats=False):
+    from je.jenkins import ANALYZE
+    from je.results import results, CaseCounts, OK, NO_REPORT
+    if stats:
+        from je.stats import numpy
+        if numpy is None:
+            raise argh.CommandError('--stats requires numpy. Install it '
+                                    'with "pip install je[stats]"')
+    numbers = _parse_build_numbers(builds)
+    states = results.build_states(job, numbers)
+    missing = [n for n in numbers if n not in states]
+    fetched = _fetch_builds(job, missing, jobs=jobs, fields=ANALYZE,
+                            raise_single=len(numbers) == 1)
+    # Builds fetched from jenkins are indexed as they are fetched, only
+    # builds that were already cached need to be indexed here
+    newly_indexed = results.build_states(job, missing)
+    for build_number, build in fetched:
         if build['build'].get('building'):
+            states[build_number] = 'building'
+            continue
+        if build_number not in newly_indexed:
+            results.index_build(job, build_number, build)
+        if build['test_report'].get('status') == 'error':
+            states[build_number] = NO_REPORT
+        else:
+            states[build_number] = OK
+    for build_number in numbers:
+        state = states.get(build_number)
+        if state == 'building':
             print 'Skipping build {} as it currently running'.format(
                 build_number)
-            continue
-        test_report = build['test_report']
-        if test_report.get('status') == 'error':
+        elif state == NO_REPORT:
             print 'Skipping build {} as no test reports were generated for it'\
                 .format(build_number)
-            continue
-        for suite in test_report['suites']:
-            suite_name = suite['name']
-            report_suite = report.get(suite_name, {})
-            for case in suite['cases']:
-                case_name = case['name'].split('@')[0].strip()
-                class_name = (case['className'] or '').split('.')[-1].strip()
-                if class_name:
-                    case_name = '{}.{}'.format(class_name, case_name)
-                test_status = case['status']
-                if test_status in ['FAILED', 'REGRESSION']:
-                    test_status = 'FAILED'
-                elif test_status in ['PASSED', 'FIXED']:
-                    test_status = 'PASSED'
-                report_case = report_suite.get(case_name, {})
-                report_case_status = report_case.get(test_status, 0)
-                report_case_status += 1
-                report_case[test_status] = report_case_status
-                report_suite[case_name] = report_case
-            report[suite_name] = report_suite
+    indexed = [n for n, state in states.items() if state == OK]
+    if stats:
+        _print_case_stats(job, indexed, failed)
+        return
+    # Counted in the index, so memory depends on the number of distinct
+    # cases rather than on the number of builds
+    report = {}
+    status_counts = results.status_counts(job, indexed)
+    for suite_name, name, status, count in status_counts:
+        suite = report.get(suite_name)
+        if suite is None:
+            suite = report[suite_name] = {}
+        case = suite.get(name)
+        if case is None:
+            case = suite[name] = CaseCounts()
+        case.add(status, count)
     for suite_name, suite in report.items():
         cases = []
         suite_has_passed = False
         suite_has_failed = False
         for case_name, case in sorted(suite.items()):
-            pass_count = case.get('PASSED', 0)
-            fail_count = case.get('FAILED', 0)
-            skip_count = case.get('SKIPPED', 0)
+            pass_count = case.passed
+            fail_count = case.failed
+            skip_count = case.skipped
             case_has_failed = False
             if pass_count and (fail_count or skip_count) \
                     and not passed_at_least_once:
@@ -271,27 +421,66 @@ def analyze(job, builds, passed_at_least_once=False, failed=False):
             print
 
 
+def _print_case_stats(job, builds, failed):
+    from je.stats import status_matrix, case_stats, numpy
+    build_numbers, cases, matrix = status_matrix(job, builds)
+    stats = case_stats(build_numbers, matrix)
+    # Most flaky first, then longest failing streak first
+    order = numpy.lexsort((-stats['longest_streak'],
+                           -stats['flake_rate']))
+    lines = []
+    for index in order:
+        runs = stats['runs'][index]
+        failures = stats['failures'][index]
+        changes = stats['changes'][index]
+        if not failures and (failed or not changes):
+            continue
+        if failures == runs:
+            case_color = colors.red
+        elif failures:
+            case_color = colors.yellow
+        else:
+            case_color = colors.green
+        suite_name, case_name = cases[index]
+        first_regression = stats['first_regression'][index]
+        lines.append('{:>6}{:>9}{:>8.0%}{:>8}{:>11}{:>9}  {}'.format(
+            runs, failures, stats['flake_rate'][index],
+            stats['longest_streak'][index],
+            first_regression or '-', changes,
+            case_color('{} / {}'.format(suite_name, case_name))))
+    if lines:
+        print colors.bold('{:>6}{:>9}{:>8}{:>8}{:>11}{:>9}  {}'.format(
+            'runs', 'failures', 'flaky', 'streak', 'regressed', 'changes',
+            'case'))
+        print '\n'.join(lines)
+
+
 @command
 @arg('job', completer=completion.job_completer)
 @arg('build', completer=completion.build_completer)
 def logs(job, build, stdout=False, tail=False):
+    from je.jenkins import jenkins
     log_path = work.log_path(job, build)
     if not tail:
-        result = jenkins.fetch_build_logs(job, build)
+        source = jenkins.fetch_build_logs(job, build)
         if stdout:
-            return result
+            with open(source, 'rb') as f:
+                shutil.copyfileobj(f, sys.stdout)
         else:
-            log_path.write_text(result, encoding='utf8')
+            _link_or_copy(source, log_path)
             print 'Log file written to {}'.format(log_path)
     else:
         if stdout:
             stream = sys.stdout
         else:
-            stream = open(log_path, 'w')
+            # The work directory log may be a hard link to the cached log,
+            # which must not be truncated
+            log_path.remove_p()
+            stream = open(log_path, 'wb')
             print 'Log file written to {}'.format(log_path)
         try:
             for chunk in jenkins.tail_build_logs(job, build):
-                stream.write(chunk.encode(encoding='utf8'))
+                stream.write(chunk)
                 stream.flush()
         except KeyboardInterrupt:
             pass
@@ -300,9 +489,181 @@ def logs(job, build, stdout=False, tail=False):
                 stream.close()
 
 
+@command
+@arg('targets',
+     nargs=argparse.ONE_OR_MORE,
+     metavar='JOB:BUILD',
+     help='Builds to follow, e.g. my-job:120 my-job:121 other-job:7')
+def tail(targets, output_files=False, max_interval=30):
+    from je.jenkins import jenkins
+    builds = []
+    for target in targets:
+        job, _, build = target.rpartition(':')
+        if not job or not build.isdigit():
+            raise argh.CommandError('Illegal target: {} (expected '
+                                    'JOB:BUILD)'.format(target))
+        builds.append((job, build))
+    prefix_colors = [colors.cyan, colors.magenta, colors.blue, colors.green,
+                     colors.yellow]
+    prefixes = {}
+    buffers = {}
+    files = {}
+    for index, (job, build) in enumerate(builds):
+        color = prefix_colors[index % len(prefix_colors)]
+        prefixes[(job, build)] = color('[{}-{}] '.format(job, build))
+        buffers[(job, build)] = ''
+        if output_files:
+            log_path = work.log_path(job, build)
+            # May be a hard link to the cached log, see logs
+            log_path.remove_p()
+            files[(job, build)] = open(log_path, 'wb')
+            print 'Log file of {}-{} written to {}'.format(
+                job, build, log_path)
+    try:
+        for job, build, chunk in jenkins.follow_build_logs(
+                builds, max_interval=max_interval):
+            target = (job, build)
+            if chunk is None:
+                lines = [buffers[target]] if buffers[target] else []
+                buffers[target] = ''
+                lines.append(colors.bold('-- end of log --'))
+            else:
+                if target in files:
+                    files[target].write(chunk)
+                    files[target].flush()
+                lines = (buffers[target] + chunk).split('\n')
+                buffers[target] = lines.pop()
+            for line in lines:
+                sys.stdout.write('{}{}\n'.format(prefixes[target], line))
+            sys.stdout.flush()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for f in files.values():
+            f.close()
+
+
+@command
+@arg('job', completer=completion.job_completer)
+@arg('pattern', help='Regular expression to search for')
+@arg('builds',
+     completer=completion.build_completer,
+     nargs=argparse.ONE_OR_MORE)
+@arg('--processes', type=int, help='Number of search processes '
+                                   '(defaults to the number of CPUs)')
+def grep(job, pattern, builds, ignore_case=False, processes=None, jobs=4):
+    from multiprocessing import Pool
+    from multiprocessing.pool import ThreadPool
+    from je.jenkins import jenkins
+    # ^ and $ match at line boundaries, as in grep
+    flags = re.MULTILINE
+    if ignore_case:
+        flags |= re.IGNORECASE
+    try:
+        re.compile(pattern, flags)
+    except re.error as e:
+        raise argh.CommandError('Invalid pattern: {} ({})'.format(pattern, e))
+    numbers = _parse_build_numbers(builds)
+
+    def fetch(number):
+        try:
+            # Already looked up in the cache by log_files
+            return number, jenkins.fetch_build_logs(job, number,
+                                                    check_cache=False)
+        except Exception as e:
+            sys.stderr.write('Failed fetching logs of build {}: {}\n'.format(
+                number, e))
+            return number, None
+
+    def log_files():
+        # Cached logs are searched right away, while missing logs are
+        # still being fetched
+        missing = []
+        for number in numbers:
+            log_path = cache.load_log_path('{}-{}'.format(job, number))
+            if log_path:
+                yield number, log_path, pattern, flags
+            else:
+                missing.append(number)
+        if not missing:
+            return
+        fetch_pool = ThreadPool(min(jobs, len(missing)))
+        try:
+            for number, log_path in fetch_pool.imap_unordered(fetch, missing):
+                if log_path:
+                    yield number, log_path, pattern, flags
+        finally:
+            fetch_pool.terminate()
+
+    pool = Pool(processes)
+    try:
+        for number, matches in pool.imap_unordered(_grep_log, log_files()):
+            for line_number, line in matches:
+                sys.stdout.write('{}:{}:{}\n'.format(number, line_number,
+                                                     line))
+            sys.stdout.flush()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        pool.terminate()
+
+
+def _grep_log(args):
+    """Search a log file for a pattern, in a worker process
+
+    The file is memory mapped rather than read, so the regular expression
+    runs over the page cache directly.
+
+    :return: A (build number, [(line number, line)]) tuple
+    """
+    import mmap
+    number, log_path, pattern, flags = args
+    regex = re.compile(pattern, flags)
+    matches = []
+    with open(log_path, 'rb') as f:
+        if not os.fstat(f.fileno()).st_size:
+            return number, matches
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            line_number = 1
+            position = 0
+            while True:
+                match = regex.search(mapped, position)
+                if not match:
+                    break
+                # position is always at the start of a line
+                line_start = mapped.rfind('\n', position, match.start()) + 1
+                line_start = line_start or position
+                line_number += mapped[position:line_start].count('\n')
+                line_end = mapped.find('\n', match.start())
+                if line_end == -1:
+                    line_end = len(mapped)
+                matches.append((line_number, mapped[line_start:line_end]))
+                # Report each line once, even if it matches several times
+                position = line_end + 1
+                line_number += 1
+                if position >= len(mapped):
+                    break
+        finally:
+            mapped.close()
+    return number, matches
+
+
+def _link_or_copy(source, target):
+    target.remove_p()
+    try:
+        os.link(source, target)
+    except OSError:
+        # e.g. the work directory is on another file system
+        shutil.copyfile(source, target)
+
+
 @command
 @arg('job', completer=completion.job_completer)
 def build(job, branch=None, descriptor=None, source=None):
+    import yaml
+    from path import path
+    from je.jenkins import jenkins
     parameters = {}
     if source:
         source_path = path(source).expanduser()
@@ -313,8 +674,8 @@ def build(job, branch=None, descriptor=None, source=None):
                 source = int(source)
             except ValueError:
                 raise argh.CommandError('Invalid source: {}'.format(source))
-            fetched_build = jenkins.fetch_build(job, source)
-            parameters = _extract_build_parameters(fetched_build['build'])
+            fetched_build = jenkins.fetch_build_info(job, source)
+            parameters = _extract_build_parameters(fetched_build)
     if branch:
         parameters['system_tests_branch'] = branch
     if descriptor:
@@ -328,8 +689,10 @@ def build(job, branch=None, descriptor=None, source=None):
 @arg('job', completer=completion.job_completer)
 @arg('build', completer=completion.build_completer)
 def parameters(job, build):
-    build = jenkins.fetch_build(job, build)
-    result = _extract_build_parameters(build['build'])
+    import yaml
+    from je.jenkins import jenkins
+    build = jenkins.fetch_build_info(job, build)
+    result = _extract_build_parameters(build)
     return yaml.safe_dump(result, default_flow_style=False)
 
 
@@ -344,11 +707,102 @@ def clear(force=False):
         work.clear()
 
 
+@command
+@arg('job', completer=completion.job_completer)
+@arg('case', help='Case name, as shown by analyze (Class.test_name)')
+@arg('--suite', help='Only show runs of the case in this suite')
+def history(job, case, suite=None):
+    from je.results import results
+    runs = results.case_history(job, case, suite)
+    if not runs:
+        raise argh.CommandError('No indexed results for {} in {}. Run '
+                                '"je analyze" on a build range first'
+                                .format(case, job))
+    # Cases with the same name in different suites are different cases
+    failing_since = {}
+    for build_number, suite_name, status, duration in runs:
+        if status == 'FAILED':
+            status_color = colors.red
+            if failing_since.get(suite_name) is None:
+                failing_since[suite_name] = build_number
+        elif status == 'PASSED':
+            status_color = colors.green
+            failing_since[suite_name] = None
+        else:
+            status_color = colors.yellow
+            failing_since.setdefault(suite_name, None)
+        print '{:<6}{:<18}{} ({:.1f}s)'.format(build_number,
+                                               status_color(status),
+                                               suite_name,
+                                               duration or 0)
+    print
+    for suite_name, since in sorted(failing_since.items()):
+        name = case
+        if len(failing_since) > 1:
+            name = '{} ({})'.format(case, suite_name)
+        if since is None:
+            print 'Last run of {} passed'.format(name)
+        else:
+            print '{} is failing since build {}'.format(name, since)
+
+
+@command
+def refresh_errors():
+    from je.errors import refresh_known_errors
+    if not configuration.known_errors_gist:
+        raise argh.CommandError('No known errors gist configured. '
+                                'Run "je init --reset --known-errors-gist"')
+    count = refresh_known_errors()
+    print 'Known errors list refreshed ({} known errors)'.format(count)
+
+
 @command
 def workdir():
     return configuration.workdir
 
 
+@cache_command
+@argh.named('stats')
+def cache_stats():
+    stats = cache.stats()
+    lookups = stats['hits'] + stats['misses']
+    hit_rate = 100.0 * stats['hits'] / lookups if lookups else 0.0
+    print '{}: {} in {} entries (max {})'.format(
+        colors.bold('Size'),
+        _format_size(stats['size']),
+        stats['entries'],
+        _format_size(stats['max_size']) if stats['max_size'] else 'none')
+    print '{}: {:.1f}% ({} hits, {} misses)'.format(
+        colors.bold('Hit rate'), hit_rate, stats['hits'], stats['misses'])
+    print '{}: {} ({})'.format(colors.bold('Evictions'),
+                               stats['evictions'],
+                               _format_size(stats['evicted_bytes']))
+    if stats['by_job']:
+        print
+        print colors.bold('Size by job:')
+        for job, size in sorted(stats['by_job'].items(),
+                                key=lambda item: item[1],
+                                reverse=True):
+            print '{:>10}  {}'.format(_format_size(size), job)
+
+
+@cache_command
+@argh.named('prune')
+@arg('--max-size', type=int, help='Size in bytes to prune the cache to')
+def cache_prune(max_size=None):
+    evicted = cache.prune(max_size)
+    print 'Evicted {} cache entries, cache size is now {}'.format(
+        evicted, _format_size(cache.stats()['size']))
+
+
+def _format_size(size):
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if size < 1024:
+            return '{:.1f}{}'.format(size, unit)
+        size /= 1024.0
+    return '{:.1f}TB'.format(size)
+
+
 def _extract_build_parameters(build):
     actions = build['actions']
     for action in actions:
@@ -383,7 +837,7 @@ def _timestamp_to_datetime(timestamp):
     return datetime_obj.strftime('%Y-%m-%d %H:%M:%S')
 
 
-def _fetch_builds(job, build_numbers):
+def _parse_build_numbers(build_numbers):
     numbers = set()
     for build in build_numbers:
         split = build.split('-')
@@ -394,5 +848,82 @@ def _fetch_builds(job, build_numbers):
         else:
             start, stop = int(split[0]), int(split[1])
             numbers |= set(i for i in range(start, stop+1))
-    numbers = [str(s) for s in sorted([int(n) for n in numbers])]
-    return [(b, jenkins.fetch_build(job, b)) for b in numbers]
+    return [str(s) for s in sorted([int(n) for n in numbers])]
+
+
+def _fetch_builds(job, build_numbers, jobs=1, fields=None, load=True,
+                  raise_single=False):
+    """Fetch builds into the cache, `jobs` at a time
+
+    :param load: If False, finished builds are not loaded from the cache,
+                 and None is returned in their place
+    :param raise_single: If True, a failure to fetch a build is raised
+                         rather than printed, for when the user asked for
+                         a single build
+
+    :return: An iterator of (build number, build) pairs, in build order.
+             Builds are loaded from the cache one at a time as the iterator
+             is consumed, with their test report suites streamed.
+    """
+    from multiprocessing.pool import ThreadPool
+    from je.jenkins import jenkins, FULL
+    fields = fields or FULL
+    numbers = _parse_build_numbers(build_numbers)
+    missing = [n for n in numbers
+               if not jenkins.is_cached(job, n, fields)]
+    # The metadata of missing builds is fetched in batches, leaving only
+    # their test reports to fetch one by one
+    builds_info = {}
+    if len(missing) > 1:
+        try:
+            builds_info = jenkins.fetch_builds_info(job, missing)
+        except Exception:
+            # Builds are fetched one by one, reporting their own failures
+            builds_info = {}
+
+    def fetch(number):
+        try:
+            return number, jenkins.cache_build(
+                job, number, fields,
+                build_info=builds_info.get(int(number))), None
+        except Exception as e:
+            if raise_single:
+                raise
+            return number, None, e
+
+    if jobs > 1 and len(missing) > 1:
+        pool = ThreadPool(min(jobs, len(missing)))
+        try:
+            # map_async with a timeout keeps the main thread responsive
+            # to KeyboardInterrupt
+            fetch_results = pool.map_async(fetch, missing).get(sys.maxint)
+        finally:
+            pool.terminate()
+    else:
+        fetch_results = [fetch(number) for number in missing]
+    running = {}
+    failed = set()
+    for number, running_build, error in fetch_results:
+        if error:
+            print 'Failed fetching build {}: {}'.format(number, error)
+            failed.add(number)
+        elif running_build:
+            running[number] = running_build
+
+    fetched = set(missing)
+
+    def load_builds():
+        for number in numbers:
+            if number in failed:
+                continue
+            if number in running or not load:
+                yield number, running.get(number)
+            elif number in fetched:
+                # Fetched above, already counted as a cache miss
+                yield number, (jenkins.load_build(job, number, stream=True) or
+                               jenkins.fetch_build(job, number, stream=True,
+                                                   fields=fields))
+            else:
+                yield number, jenkins.fetch_build(job, number, stream=True,
+                                                  fields=fields)
+    return load_builds()
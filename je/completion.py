@@ -14,25 +14,102 @@
 # limitations under the License.
 ############
 
-from je.jenkins import jenkins
+import json
+import os
+import subprocess
+import sys
+import time
+
+from je.cache import cache
+from je.configuration import configuration
 
 
 class Completion(object):
+    """Shell completion of job names and build numbers
+
+    Completion reads job names and build numbers from a small on disk
+    cache. When an entry is older than `completion_ttl` seconds, the stale
+    values are used and a background process refreshes them, so TAB never
+    waits on jenkins (other than the very first time).
+    """
+
+    # Don't spawn another background refresh while one is probably running
+    refresh_grace = 60
 
     @staticmethod
     def job_completer(prefix, **kwargs):
-        jobs = jenkins.list_jobs().get('jobs', [])
-        for j in jobs:
-            name = j.get('name')
+        for name in completion.jobs():
             if name.startswith(prefix):
                 yield name
 
     @staticmethod
     def build_completer(prefix, parsed_args, **kwargs):
         job = parsed_args.job
-        builds = jenkins.list_builds(job, only_number=True)
-        for build in builds:
+        for build in completion.builds(job):
             build = str(build)
             if build.startswith(prefix):
                 yield build
+
+    def jobs(self):
+        return self._load('jobs', ['jobs'])
+
+    def builds(self, job):
+        return self._load('builds-{}'.format(job), ['builds', job])
+
+    def save_jobs(self, jobs):
+        self._save('jobs', jobs)
+
+    def save_builds(self, job, builds):
+        self._save('builds-{}'.format(job), builds)
+
+    def refresh(self, kind, job=None):
+        from je.jenkins import jenkins
+        if kind == 'jobs':
+            jobs = jenkins.list_jobs().get('jobs', [])
+            values = [j.get('name') for j in jobs]
+            self.save_jobs(values)
+        else:
+            values = list(jenkins.list_builds(job, only_number=True))
+            self.save_builds(job, values)
+        return values
+
+    def _load(self, name, refresh_args):
+        entry_path = self._entry_path(name)
+        try:
+            entry = json.loads(entry_path.text())
+        except (IOError, OSError, ValueError):
+            return self.refresh(*refresh_args)
+        now = time.time()
+        if now - entry['fetched_at'] > configuration.completion_ttl and \
+                now - entry.get('refresh_started', 0) > self.refresh_grace:
+            entry['refresh_started'] = now
+            entry_path.write_text(json.dumps(entry))
+            self._refresh_in_background(refresh_args)
+        return entry['values']
+
+    def _save(self, name, values):
+        entry_path = self._entry_path(name)
+        entry_path.dirname().mkdir_p()
+        tmp_path = entry_path + '.tmp{}'.format(os.getpid())
+        tmp_path.write_text(json.dumps({
+            'fetched_at': time.time(),
+            'values': values
+        }))
+        tmp_path.rename(entry_path)
+
+    @staticmethod
+    def _refresh_in_background(refresh_args):
+        with open(os.devnull, 'r+') as devnull:
+            subprocess.Popen(
+                [sys.executable, '-m', 'je.completion'] + refresh_args,
+                stdin=devnull, stdout=devnull, stderr=devnull,
+                close_fds=True, preexec_fn=os.setsid)
+
+    @staticmethod
+    def _entry_path(name):
+        return cache.cache_dir / 'completion' / '{}.json'.format(name)
 completion = Completion()
+
+
+if __name__ == '__main__':
+    completion.refresh(*sys.argv[1:])
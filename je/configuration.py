@@ -15,12 +15,14 @@
 ############
 
 import argh
-import yaml
-from path import path
 
 
 class Configuration(object):
 
+    def __init__(self):
+        self._conf = None
+        self._conf_stamp = None
+
     def save(self,
              jenkins_username,
              jenkins_password,
@@ -29,6 +31,8 @@ class Configuration(object):
              jenkins_system_tests_base,
              workdir,
              reset):
+        import yaml
+        from path import path
         if not self.conf_dir.exists():
             self.conf_dir.mkdir()
         conf = self.conf_dir / 'config.yaml'
@@ -49,17 +53,33 @@ class Configuration(object):
             'jenkins_system_tests_base': jenkins_system_tests_base,
             'workdir': str(workdir)
         }, default_flow_style=False))
+        self.reload()
 
     @property
     def conf_dir(self):
+        from path import path
         return path('~/.je').expanduser()
 
     @property
     def conf(self):
         conf = self.conf_dir / 'config.yaml'
-        if not conf.exists():
+        try:
+            stat = conf.stat()
+        except OSError:
             raise argh.CommandError('Not initialized. Run "je init"')
-        return yaml.safe_load(conf.text())
+        stamp = (stat.st_mtime, stat.st_size)
+        if self._conf is None or stamp != self._conf_stamp:
+            import yaml
+            self._conf = yaml.safe_load(conf.text())
+            self._conf_stamp = stamp
+        return self._conf
+
+    def reload(self):
+        """Drop the memoized configuration so the next access re-reads
+        config.yaml, even if its modification time did not change
+        """
+        self._conf = None
+        self._conf_stamp = None
 
     @property
     def jenkins_base_url(self):
@@ -81,7 +101,40 @@ class Configuration(object):
     def known_errors_gist(self):
         return self.conf.get('known_errors_gist')
 
+    @property
+    def cache_max_size(self):
+        return self.conf.get('cache_max_size', 10 * 1024 ** 3)
+
+    @property
+    def completion_ttl(self):
+        return self.conf.get('completion_ttl', 300)
+
+    @property
+    def known_errors_ttl(self):
+        return self.conf.get('known_errors_ttl', 3600)
+
     @property
     def workdir(self):
+        from path import path
         return path(self.conf['workdir'])
+
+    @property
+    def http_pool_size(self):
+        return self.conf.get('http_pool_size', 10)
+
+    @property
+    def http_connect_timeout(self):
+        return self.conf.get('http_connect_timeout', 10)
+
+    @property
+    def http_read_timeout(self):
+        return self.conf.get('http_read_timeout', 300)
+
+    @property
+    def http_retries(self):
+        return self.conf.get('http_retries', 3)
+
+    @property
+    def http_backoff_factor(self):
+        return self.conf.get('http_backoff_factor', 0.5)
 configuration = Configuration()
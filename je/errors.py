@@ -1,58 +1,245 @@
+import hashlib
+import json
+import sys
+import time
 import yaml
 import re
+import sre_constants
+import sre_parse
 import requests
+import argh
 
 from je.configuration import configuration
+from je.cache import cache
+from je.session import session
+from je.timings import timings, KNOWN_ERRORS
 
 
-_known_errors = list()
+# None until loaded, so an empty gist is not downloaded again
+_known_errors = None
+_matcher = None
 
 
-def _get_known_errors_gist():
+class KnownErrorsMatcher(object):
+    """Match stack traces against a list of known errors
+
+    Every pattern is compiled once. The longest literal substring that any
+    match of the pattern must contain is extracted up front, so the full
+    regex only runs against stack traces that contain that literal.
+    """
+
+    def __init__(self, known_errors):
+        self._errors = []
+        for error in known_errors or []:
+            pattern = error['pattern']
+            self._errors.append((_required_literal(pattern),
+                                 re.compile(pattern),
+                                 error))
+
+    def match(self, stack_trace):
+        """Return a list of possible explanations to the passed stack trace
+
+        :param stack_trace: Stack trace of a failed test case
+        :return: Formatted messages of all matching known errors, in the
+                 order they appear in the known errors list
+        """
+        possible_causes = []
+
+        for literal, regex, error in self._errors:
+            if literal and literal not in stack_trace:
+                continue
+            search = regex.search(stack_trace)
+            if search:
+                groups = []
+                group_ids = error.get('group_ids', list())
+                try:
+                    for group_id in group_ids:
+                        groups.append(search.group(group_id))
+
+                    message = error['message'].format(*groups)
+                except IndexError:
+                    # IndexError will be raised if: a. group_id is out of
+                    # range, or b. formatted message expects more items than
+                    # len(groups)
+                    continue
+
+                possible_causes.append(message)
+
+        return possible_causes
+
+
+def _required_literal(pattern):
+    """Return the longest literal every match of `pattern` contains, or
+    None if no such literal can be safely determined
+    """
+    try:
+        parsed = sre_parse.parse(pattern)
+    except sre_constants.error:
+        return None
+    state = getattr(parsed, 'state', None) or parsed.pattern
+    if state.flags & re.IGNORECASE:
+        return None
+    literals = _required_literals(parsed)
+    if not literals:
+        return None
+    return max(literals, key=len)
+
+
+def _required_literals(subpattern):
+    literals = []
+    current = []
+    for op, av in subpattern:
+        if op == sre_constants.LITERAL:
+            current.append(unichr(av))
+            continue
+        if current:
+            literals.append(u''.join(current))
+            current = []
+        if op == sre_constants.SUBPATTERN:
+            literals.extend(_required_literals(av[-1]))
+        elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT) \
+                and av[0] >= 1:
+            literals.extend(_required_literals(av[2]))
+        # Anything else (alternations, character classes, optional
+        # repeats, lookarounds, ...) guarantees no literal
+    if current:
+        literals.append(u''.join(current))
+    return literals
+
+
+def _get_known_errors_gist(force=False):
     """Get the known errors list from the GitHub gist, and cache it
+
+    The parsed list is cached on disk along with the gist ETag. Within
+    `known_errors_ttl` seconds the cached copy is used as is, after that
+    the gist is revalidated with If-None-Match. If fetching fails, the stale
+    cached copy (if any) is used.
+
+    :param force: Revalidate the gist even if the cached copy is fresh
+    :return: False if neither the gist nor a cached copy could be loaded,
+             in which case the known errors list is empty
     """
 
-    global _known_errors
+    cached = _load_cached_gist()
+    now = time.time()
+    if cached and not force and \
+            now - cached['fetched_at'] < configuration.known_errors_ttl:
+        _set_known_errors(cached['errors'])
+        return True
 
     url = 'http://api.github.com/gists'
     file_url = '{0}/{1}'.format(url, configuration.known_errors_gist)
-    r = requests.get(file_url)
+    headers = {}
+    if cached and cached.get('etag'):
+        headers['If-None-Match'] = cached['etag']
+    try:
+        r = session.request('GET', file_url, headers=headers)
+    except requests.RequestException as e:
+        return _use_stale_gist(cached, e)
+    if r.status_code == 304 and cached:
+        cached['fetched_at'] = now
+        _save_cached_gist(cached)
+        _set_known_errors(cached['errors'])
+        return True
     try:
         response = r.json()
         known_errors_file = response.pop('files')
         known_errors_file = known_errors_file.itervalues().next()
-        content = yaml.load(known_errors_file['content'])
-        _known_errors = content
-    except (KeyError, ValueError):
-        print "Something went wrong - can't get known errors list from the gist"
+        content = yaml.load(known_errors_file['content']) or []
+    except (KeyError, ValueError, StopIteration) as e:
+        return _use_stale_gist(cached, e)
+    _save_cached_gist({
+        'etag': r.headers.get('ETag'),
+        'fetched_at': now,
+        'errors': content
+    })
+    _set_known_errors(content)
+    return True
+
+
+def _set_known_errors(known_errors):
+    global _known_errors, _matcher
+
+    _known_errors = known_errors
+    _matcher = KnownErrorsMatcher(known_errors)
+
+
+def _use_stale_gist(cached, error):
+    # Written to stderr in a single write, as report workers may share it
+    if cached:
+        sys.stderr.write("Can't refresh known errors list from the gist "
+                         "({}), using the cached copy\n".format(error))
+        _set_known_errors(cached['errors'])
+        return True
+    sys.stderr.write("Something went wrong - can't get known errors list "
+                     "from the gist ({})\n".format(error))
+    _set_known_errors([])
+    return False
+
+
+def _gist_cache_path():
+    return cache.cache_dir / 'known-errors' / '{}.json'.format(
+        configuration.known_errors_gist)
+
+
+def _load_cached_gist():
+    gist_path = _gist_cache_path()
+    if not gist_path.exists():
+        return None
+    try:
+        return json.loads(gist_path.text())
+    except ValueError:
+        return None
+
+
+def _save_cached_gist(value):
+    gist_path = _gist_cache_path()
+    gist_path.dirname().mkdir_p()
+    tmp_path = gist_path + '.tmp'
+    tmp_path.write_text(json.dumps(value))
+    tmp_path.rename(gist_path)
+
+
+def refresh_known_errors():
+    """Revalidate the known errors gist, ignoring the cache TTL
+
+    :return: The number of known errors
+    """
+    if not _get_known_errors_gist(force=True):
+        raise argh.CommandError('Known errors list could not be refreshed')
+    return len(_known_errors)
+
+
+def load_known_errors():
+    """Load the known errors list, unless it was already loaded or no
+    known errors gist is configured"""
+    if configuration.known_errors_gist and _known_errors is None:
+        _get_known_errors_gist()
+
+
+def known_errors_digest():
+    """Return a hex digest of the known errors list (loading it if it
+    wasn't loaded yet), or None if no known errors gist is configured
+    """
+    if not configuration.known_errors_gist:
+        return None
+    load_known_errors()
+    return hashlib.sha1(json.dumps(_known_errors,
+                                   sort_keys=True)).hexdigest()
 
 
 def _match_stack_trace_to_errors(stack_trace):
     """Return a list of possible explanations to the passed stack trace
 
-    :param stack_trace: Stack trace of
-    :return:
+    :param stack_trace: Stack trace of a failed test case
+    :return: Formatted messages of all matching known errors
     """
-    possible_causes = []
-
-    for error in _known_errors:
-        search = re.search(error['pattern'], stack_trace)
-        if search:
-            groups = []
-            group_ids = error.get('group_ids', list())
-            try:
-                for group_id in group_ids:
-                    groups.append(search.group(group_id))
-
-                message = error['message'].format(*groups)
-            except IndexError:
-                # IndexError will be raised if: a. group_id is out of range,
-                # or b. formatted message expects more items than len(groups)
-                continue
+    global _matcher
 
-            possible_causes.append(message)
-
-    return possible_causes
+    if _matcher is None:
+        _matcher = KnownErrorsMatcher(_known_errors)
+    with timings.phase(KNOWN_ERRORS):
+        return _matcher.match(stack_trace)
 
 
 def handle_failure(cases, case, colored_cause, log_file):
@@ -75,8 +262,7 @@ def handle_failure(cases, case, colored_cause, log_file):
     stack_trace = stack_trace.replace('\r', '').replace('\n', '')
 
     # Load the list once and cache it in memory
-    if not _known_errors:
-        _get_known_errors_gist()
+    load_known_errors()
 
     probable_causes = _match_stack_trace_to_errors(stack_trace)
     if probable_causes:
@@ -14,13 +14,47 @@
 # limitations under the License.
 ############
 
+import heapq
+import os
+import sys
 import time
 
 import argh
 import requests
 
 from je.configuration import configuration
-from je.cache import cache
+from je import streaming
+from je.cache import cache, CHUNK_SIZE
+from je.results import results
+from je.session import session
+from je.timings import timings
+
+
+# Test report field sets, from the smallest to the largest
+ANALYZE = 'analyze'
+REPORT = 'report'
+FULL = 'full'
+FIELDS = [ANALYZE, REPORT, FULL]
+REPORT_TREES = {
+    ANALYZE: 'suites[name,cases[name,className,status,duration]]',
+    REPORT: 'suites[name,cases[name,className,status,duration,'
+            'errorDetails]]',
+    FULL: None
+}
+CASE_DETAILS_FIELDS = 'errorStackTrace,stdout,stderr'
+# Cases whose details are needed are fetched in a single range if at most
+# this many other cases are between them
+CASE_DETAILS_MAX_GAP = 10
+BUILDS_TREE = 'builds[number,result,actions[causes[shortDescription]],' \
+              'timestamp,building]'
+# Build metadata, as cached with the build's test report
+BUILD_INFO_TREE = 'actions[causes[shortDescription],parameters[name,value]],' \
+                  'result,duration,timestamp,building'
+# The metadata of builds is fetched in a single range if at most this many
+# other builds are between them
+BUILDS_INFO_MAX_GAP = 10
+# Number of builds listed per request, when listing builds incrementally
+LIST_BUILDS_PAGE = 20
 
 
 class Jenkins(object):
@@ -38,110 +72,465 @@ class Jenkins(object):
                 'Failed building job: {} [status={}, parameters={}]'
                 .format(job, response.status_code, parameters))
 
-    def list_builds(self, job, only_number=False):
+    def list_builds(self, job, only_number=False, limit=None, offset=0):
+        """List the builds of a job, oldest first
+
+        :param limit: List at most this many builds
+        :param offset: Skip this many of the newest builds
+        """
+        end = offset + limit if limit is not None else None
         if only_number:
-            tree = 'builds[number]'
+            builds = self._query('job/{}'.format(job),
+                                 tree='builds[number]{}'.format(
+                                     _tree_range(offset, end)))
+            return reversed([build['number'] for build in builds['builds']])
+        builds = self._list_build_summaries(job, end)
+        return reversed(builds[offset:end])
+
+    def _list_build_summaries(self, job, count=None):
+        """Return summaries of the newest `count` builds of a job (all of
+        them if `count` is None), newest first
+
+        Summaries of finished builds are cached, so only builds newer than
+        the newest cached finished build, and builds that were still
+        building when last listed, are fetched.
+        """
+        # Like build keys, <job>-<suffix>, so cache stats attribute it to
+        # the job
+        listing_key = '{}-builds'.format(job)
+        listing = cache.load(listing_key) or {'builds': [],
+                                              'building': [],
+                                              'complete': False}
+        cached = listing['builds']
+        building = listing['building']
+        if count is None and not listing['complete']:
+            # Everything is needed, and not everything is cached
+            cached = []
+            building = []
+        boundaries = [n - 1 for n in building]
+        if cached:
+            boundaries.append(cached[0]['number'])
+        boundary = min(boundaries) if boundaries else None
+
+        resource = 'job/{}'.format(job)
+        fetched = []
+        first_build = None
+        complete = listing['complete']
+        if boundary is None and count is None:
+            response = self._query(resource, tree='firstBuild[number],'
+                                                  '{}'.format(BUILDS_TREE))
+            fetched = response['builds']
+            first_build = response.get('firstBuild')
+            complete = True
         else:
-            tree = 'builds[number,result,actions[causes[shortDescription]],' \
-                   'timestamp,building]'
-        builds = self._query('job/{}'.format(job), tree=tree)
-        results = []
-        for build in builds['builds']:
-            number = build['number']
-            if only_number:
-                results.append(number)
-                continue
-            result = build['result']
-            actions = build['actions']
-            timestamp = build['timestamp']
-            building = build['building']
-            causes = []
-            for action in actions:
-                action_causes = action.get('causes')
-                if not action_causes:
-                    continue
-                for cause in action_causes:
-                    description = cause.get('shortDescription')
-                    if not description:
-                        continue
-                    causes.append(description)
-            results.append({
-                'number': number,
-                'result': result,
-                'cause': ', '.join(causes),
-                'timestamp': timestamp,
-                'building': building
-            })
-        return reversed(results)
-
-    def fetch_build(self, job, build):
+            size = count if boundary is None else LIST_BUILDS_PAGE
+            while True:
+                response = self._query(
+                    resource, tree='firstBuild[number],{}{}'.format(
+                        BUILDS_TREE, _tree_range(len(fetched),
+                                                 len(fetched) + size)))
+                page = response['builds']
+                first_build = response.get('firstBuild')
+                fetched.extend(page)
+                if len(page) < size:
+                    complete = True
+                    break
+                if boundary is None:
+                    # Only the newest `count` builds were asked for, older
+                    # builds are not known yet
+                    complete = False
+                    break
+                if page[-1]['number'] <= boundary:
+                    break
+                # Page down to the cached builds even past `count`, so no
+                # gap is left between them and the fetched builds
+                size *= 2
+
+        summaries = [_build_summary(build) for build in fetched]
+        fetched_numbers = set(summary['number'] for summary in summaries)
+        first_number = first_build['number'] if first_build else None
+        summaries.extend(summary for summary in cached
+                         if summary['number'] not in fetched_numbers and
+                         (first_number is None or
+                          summary['number'] >= first_number))
+        if count is not None and len(summaries) < count and not complete:
+            # Older builds than the cached ones were asked for
+            response = self._query(resource, tree='{}{}'.format(
+                BUILDS_TREE, _tree_range(len(summaries), count)))
+            older = response['builds']
+            if len(older) < count - len(summaries):
+                complete = True
+            known_numbers = set(summary['number'] for summary in summaries)
+            summaries.extend(_build_summary(build) for build in older
+                             if build['number'] not in known_numbers)
+        summaries.sort(key=lambda summary: summary['number'], reverse=True)
+
+        cache.save(listing_key, {
+            'builds': [summary for summary in summaries
+                       if not summary['building']],
+            'building': [summary['number'] for summary in summaries
+                         if summary['building']],
+            'complete': complete
+        })
+        return summaries
+
+    @staticmethod
+    def is_cached(job, build, fields=FULL):
+        """Whether a build is cached with (at least) the test report fields
+        needed by `fields`. A build that is not is counted as a cache miss,
+        as it is about to be fetched."""
+        build_key = '{}-{}'.format(job, build)
+        if cache.exists(build_key):
+            cached_fields = cache.load_section(build_key, 'fields') or FULL
+            if FIELDS.index(cached_fields) >= FIELDS.index(fields):
+                return True
+        cache.miss()
+        return False
+
+    def fetch_build_info(self, job, build):
+        """Like fetch_build, but only return the build metadata (without
+        its test report). Cached builds are served without loading their
+        test report.
+        """
+        build_key = '{}-{}'.format(job, build)
+        cached_info = cache.load_section(build_key, 'build')
+        if cached_info:
+            cache.hit()
+            return cached_info
+        return self.fetch_build(job, build, stream=True,
+                                fields=ANALYZE)['build']
+
+    def fetch_build(self, job, build, stream=False, fields=FULL):
+        """Fetch a build and its test report
+
+        :param stream: If True, the `suites` of the returned test report are
+                       an iterator, reading the report from the cache one
+                       suite at a time, instead of a list
+        :param fields: Which test case fields are needed. One of FULL (all
+                       of them), REPORT (everything but stdout, stderr and
+                       errorStackTrace) or ANALYZE (only name, className,
+                       status and duration)
+        """
+        build_key = '{}-{}'.format(job, build)
+        if self.is_cached(job, build, fields):
+            cached_build = self._load_build(build_key, stream)
+            if cached_build:
+                cache.hit()
+                return cached_build
+        running_build = self.cache_build(job, build, fields)
+        if running_build:
+            return running_build
+        return self._load_build(build_key, stream)
+
+    def load_build(self, job, build, stream=False):
+        """Load a build from the cache, without fetching it, e.g. right
+        after `cache_build` fetched it. Not counted as a cache hit.
+
+        :param stream: See fetch_build
+        :return: The build, or None if it is not cached
+        """
+        return self._load_build('{}-{}'.format(job, build), stream)
+
+    def fetch_builds_info(self, job, builds):
+        """Fetch the metadata of several builds with a request per range of
+        builds close to each other, instead of a request per build
+
+        Builds are located in the (newest first) builds list of the job by
+        their distance from the newest build, which only holds as long as no
+        builds were deleted in between. The returned numbers are checked, so
+        builds that are not where expected are just missing from the result.
+
+        :return: A dict of build number (int) to its metadata, as fetched by
+                 `cache_build`. Builds that were not found are missing.
+        """
+        numbers = set(int(build) for build in builds)
+        resource = 'job/{}'.format(job)
+        last_build = self._query(resource,
+                                 tree='lastBuild[number]').get('lastBuild')
+        if not last_build:
+            return {}
+        newest = last_build['number']
+        indices = sorted(newest - number for number in numbers
+                         if number <= newest)
+        builds_info = {}
+        for start, end in _index_ranges(indices, BUILDS_INFO_MAX_GAP):
+            response = self._query(resource, tree='builds[number,{}]{}'.format(
+                BUILD_INFO_TREE, _tree_range(start, end)))
+            for build in response['builds']:
+                number = build.pop('number')
+                if number in numbers:
+                    builds_info[number] = build
+        return builds_info
+
+    def cache_build(self, job, build, fields=FULL, build_info=None):
+        """Fetch a build and its test report from jenkins into the cache
+
+        :param fields: See fetch_build
+        :param build_info: The build metadata, if already fetched (see
+                           `fetch_builds_info`), so only the test report
+                           is fetched
+        :return: None, or the build if it is currently running, in which
+                 case it is not cached
+        """
         build_key = '{}-{}'.format(job, build)
-        cached_build = cache.load(build_key)
-        if cached_build:
-            return cached_build
-        print 'Build {} not in cache, ' \
-              'retrieving from jenkins'.format(build_key)
+        # A single write, as builds may be fetched from several threads
+        sys.stdout.write('Build {} not in cache, retrieving from '
+                         'jenkins\n'.format(build_key))
+        build_number = build
         resource = 'job/{}/{}'.format(job, build)
-        build = self._query(
-            resource,
-            tree='actions['
-                 'causes[shortDescription],'
-                 'parameters[name,value]'
-                 '],'
-                 'result,'
-                 'duration,'
-                 'timestamp,'
-                 'building')
-        building = build.get('building')
-        if not building:
-            try:
-                test_report = self._query('{}/testReport'.format(resource))
-            except Exception:
-                test_report = {'status': 'error'}
-        else:
-            test_report = {}
-        result = {
+        build = build_info or self._query(resource, tree=BUILD_INFO_TREE)
+        if build.get('building'):
+            return {
+                'build': build,
+                'test_report': {}
+            }
+        report_resource = '{}/testReport/api/json'.format(resource)
+        if REPORT_TREES[fields]:
+            report_resource = '{}?tree={}'.format(report_resource,
+                                                  REPORT_TREES[fields])
+        record = {
+            'build': build,
+            'fields': fields
+        }
+        try:
+            self._save_test_report(build_key, record, report_resource)
+        except Exception:
+            record['test_report'] = {'status': 'error'}
+            cache.save(build_key, record)
+        results.index_build(job, build_number,
+                            self._load_build(build_key, stream=True))
+        return None
+
+    def fetch_cases_details(self, job, build, suite_index, case_indices):
+        """Fetch the heavy fields (stdout, stderr and errorStackTrace) of
+        test cases of a single suite, for builds fetched without them
+
+        The cases are fetched in as few ranged requests as possible: cases
+        that are close to each other in the suite are fetched in a single
+        range, along with the few cases between them. Details are cached
+        per suite.
+
+        :param suite_index: The index of the suite in the report
+        :param case_indices: The indices of the cases in their suite
+        :return: A dict of case index to the case's details
+        """
+        details_key = '{}-{}.s{}'.format(job, build, suite_index)
+        cached = cache.load(details_key) or {'cases': {}}
+        details = {int(index): case
+                   for index, case in cached['cases'].items()}
+        missing = sorted(set(case_indices) - set(details))
+        if not missing:
+            return details
+        resource = 'job/{}/{}/testReport'.format(job, build)
+        for start, end in _index_ranges(missing, CASE_DETAILS_MAX_GAP):
+            report = self._query(
+                resource, tree='suites[cases[{}]{}]{}'.format(
+                    CASE_DETAILS_FIELDS,
+                    _tree_range(start, end),
+                    _tree_range(suite_index, suite_index + 1)))
+            for index, case in enumerate(report['suites'][0]['cases'],
+                                         start):
+                if index in missing:
+                    details[index] = case
+        cache.save(details_key, {'cases': details}, kind='case')
+        return details
+
+    def _save_test_report(self, build_key, record, resource):
+        # The report is streamed from the response into the cache one suite
+        # at a time, so it is never held in memory as a whole
+        response = self._raw_query(resource, stream=True)
+        try:
+            response.raise_for_status()
+            response.raw.decode_content = True
+            attributes = {}
+            suites = streaming.iter_suites(response.raw, attributes)
+            cache.save_stream(build_key, record, 'test_report',
+                              streaming.dump_report(suites, attributes))
+        finally:
+            response.close()
+
+    @staticmethod
+    def _load_build(build_key, stream):
+        if not stream:
+            return cache.load(build_key)
+        build = cache.load_section(build_key, 'build')
+        test_report = cache.open_section(build_key, 'test_report')
+        if build is None or test_report is None:
+            return None
+        return {
             'build': build,
-            'test_report': test_report
+            'test_report': streaming.load_report(test_report)
         }
-        if not building:
-            cache.save(build_key, result)
-        return result
 
-    def fetch_build_logs(self, job, build):
+    def fetch_build_logs(self, job, build, check_cache=True):
+        """Fetch the console log of a build, streaming it to disk
+
+        Logs of running builds are kept in the cache as partial logs, and
+        later calls only fetch what was added to the log since.
+
+        :param check_cache: If False, the caller already looked the log up
+                            in the cache (counting a miss), so it is not
+                            looked up again
+
+        :return: The path of the log file. For finished builds this is the
+                 cached log. For running builds it is the partial log, which
+                 is appended to as the log is fetched again.
+        """
         build_key = '{}-{}'.format(job, build)
-        build_logs = cache.load_log(build_key)
-        if build_logs:
-            return build_logs
-        print 'Logs not in cache, retrieving from jenkins'
-        resource = 'job/{}/{}/consoleText'.format(job, build)
-        response = self._raw_query(resource)
-        build_logs = response.text
-        fetched_build = self.fetch_build(job, build)
-        if not fetched_build['build'].get('building'):
-            cache.save_log(build_key, build_logs)
-        return build_logs
+        if check_cache:
+            log_path = cache.load_log_path(build_key)
+            if log_path:
+                return log_path
+        partial_path, _ = cache.load_partial_log(build_key)
+        if not partial_path:
+            # Checked before fetching the log, so a build that finishes
+            # while its log is downloaded is not cached with a truncated log
+            building = self._query('job/{}/{}'.format(job, build),
+                                   tree='building').get('building')
+            if not building:
+                # A single write, as logs may be fetched from several threads
+                sys.stdout.write('Logs not in cache, retrieving from '
+                                 'jenkins\n')
+                return self._download_build_logs(job, build)
+        sys.stdout.write('Logs not complete in cache, retrieving the rest '
+                         'from jenkins\n')
+        while True:
+            size, more, log_path = self._poll_build_logs(job, build)
+            if not more or not size:
+                return log_path
 
     def tail_build_logs(self, job, build):
         build_key = '{}-{}'.format(job, build)
-        build_logs = cache.load_log(build_key)
-        if build_logs:
-            yield build_logs
-        else:
-            resource = 'job/{}/{}/logText/progressiveText'.format(job, build)
-            next_index = 0
-            while True:
-                response = self._raw_query(resource,
-                                           method='POST',
-                                           data={'start': next_index})
-                previous_index = next_index
-                next_index = int(response.headers.get('X-Text-Size'))
-                if previous_index == next_index:
-                    time.sleep(1)
-                else:
-                    yield response.text
-                if response.headers.get('X-More-Data') != 'true':
-                    break
+        log_path = cache.load_log_path(build_key)
+        for chunk in self._cached_build_logs(build_key, log_path):
+            yield chunk
+        if log_path:
+            return
+        while True:
+            size, more, log_path = self._poll_build_logs(job, build)
+            if size:
+                for chunk in self._read_log_end(log_path, size):
+                    yield chunk
+            elif more:
+                time.sleep(1)
+            if not more:
+                break
+
+    def follow_build_logs(self, targets, min_interval=1, max_interval=30):
+        """Follow the logs of several builds at once, from a single loop
+
+        Each build is polled on its own schedule: right away after new
+        output, backing off exponentially (up to `max_interval` seconds)
+        while its log is idle or polling it fails.
+
+        :param targets: A list of (job, build) pairs
+        :return: An iterator of (job, build, chunk) tuples, in the order the
+                 chunks arrive. A chunk of None marks the end of a build's
+                 log.
+        """
+        schedule = []
+        for index, (job, build) in enumerate(targets):
+            build_key = '{}-{}'.format(job, build)
+            log_path = cache.load_log_path(build_key)
+            for chunk in self._cached_build_logs(build_key, log_path):
+                yield job, build, chunk
+            if log_path:
+                yield job, build, None
+            else:
+                heapq.heappush(schedule, (0, index, job, build, min_interval))
+        while schedule:
+            due, index, job, build, interval = heapq.heappop(schedule)
+            delay = due - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            try:
+                size, more, log_path = self._poll_build_logs(job, build)
+            except argh.CommandError as e:
+                # e.g. the build does not exist, polling it again won't help
+                sys.stderr.write('Failed following {}-{}: {}\n'.format(
+                    job, build, e))
+                yield job, build, None
+                continue
+            except requests.RequestException as e:
+                sys.stderr.write('Failed polling {}-{}: {}\n'.format(
+                    job, build, e))
+                size, more = 0, True
+            if size:
+                for chunk in self._read_log_end(log_path, size):
+                    yield job, build, chunk
+                interval = min_interval
+                due = time.time()
+            else:
+                interval = min(interval * 2, max_interval)
+                due = time.time() + interval
+            if more:
+                heapq.heappush(schedule, (due, index, job, build, interval))
+            else:
+                yield job, build, None
+
+    @staticmethod
+    def _cached_build_logs(build_key, log_path):
+        """Yield the cached log of a build (as looked up by
+        `cache.load_log_path`) or else its partial log, in chunks"""
+        if not log_path:
+            log_path, _ = cache.load_partial_log(build_key)
+        if log_path:
+            with open(log_path, 'rb') as f:
+                for chunk in iter(lambda: f.read(CHUNK_SIZE), ''):
+                    yield chunk
+
+    def _download_build_logs(self, job, build):
+        build_key = '{}-{}'.format(job, build)
+        resource = 'job/{}/{}/consoleText'.format(job, build)
+        response = self._raw_query(resource, stream=True)
+        try:
+            return cache.save_log_stream(build_key,
+                                         response.iter_content(CHUNK_SIZE))
+        finally:
+            response.close()
+
+    def _poll_build_logs(self, job, build):
+        """Fetch the next part of a build's log, from where the partial log
+        in the cache ends. The new part is streamed into the partial log,
+        so it is never held in memory as a whole.
+
+        :return: A (size, more, path) tuple: the size of the new part of the
+                 log (which ends the file at path), whether more of the log
+                 is expected, and the path of the partial log (or of the
+                 cached log once the build is done)
+        """
+        build_key = '{}-{}'.format(job, build)
+        partial_path, offset = cache.load_partial_log(build_key)
+        previous_size = partial_path.getsize() if partial_path else 0
+        resource = 'job/{}/{}/logText/progressiveText'.format(job, build)
+        response = self._raw_query(resource,
+                                   method='POST',
+                                   data={'start': offset},
+                                   stream=True)
+        try:
+            next_offset = int(response.headers.get('X-Text-Size'))
+            more = response.headers.get('X-More-Data') == 'true'
+            if next_offset != offset or not more or not partial_path:
+                chunks = response.iter_content(CHUNK_SIZE) \
+                    if next_offset != offset else []
+                partial_path = cache.append_partial_log(build_key, chunks,
+                                                        next_offset,
+                                                        complete=not more)
+        finally:
+            response.close()
+        return partial_path.getsize() - previous_size, more, partial_path
+
+    @staticmethod
+    def _read_log_end(log_path, size):
+        """Yield the last `size` bytes of a log, in chunks"""
+        with open(log_path, 'rb') as f:
+            f.seek(-size, os.SEEK_END)
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), ''):
+                yield chunk
+
+    @staticmethod
+    def pool_stats():
+        return session.stats()
 
     def _query(self, resource, tree=None):
         if tree:
@@ -153,16 +542,67 @@ class Jenkins(object):
         return response.json()
 
     @staticmethod
-    def _raw_query(resource, method='GET', data=None):
+    def _raw_query(resource, method='GET', data=None, stream=False):
         url = '{}/{}/{}'.format(configuration.jenkins_base_url,
                                 configuration.jenkins_system_tests_base,
                                 resource)
-        response = requests.request(method, url,
-                                    auth=(configuration.jenkins_username,
-                                          configuration.jenkins_password),
-                                    data=data)
+        start = time.time()
+        response = session.request(method, url,
+                                   auth=(configuration.jenkins_username,
+                                         configuration.jenkins_password),
+                                   data=data,
+                                   stream=stream)
+        if timings.enabled:
+            if stream:
+                size = response.headers.get('Content-Length')
+                size = int(size) if size else None
+            else:
+                size = len(response.content)
+            timings.request(method, url, response.status_code, size,
+                            time.time() - start)
         if response.status_code == 404:
             raise argh.CommandError('Resource not found. (404)'.format(
                 resource))
         return response
 jenkins = Jenkins()
+
+
+def _tree_range(start, end):
+    """Return a tree query range selector of the items [start, end)"""
+    if end is not None:
+        return '{{{},{}}}'.format(start, end)
+    elif start:
+        return '{{{},}}'.format(start)
+    return ''
+
+
+def _index_ranges(indices, max_gap):
+    """Return [start, end) ranges covering sorted `indices`, merging
+    indices at most `max_gap` apart into a single range"""
+    ranges = []
+    for index in indices:
+        if ranges and index - ranges[-1][1] <= max_gap:
+            ranges[-1][1] = index + 1
+        else:
+            ranges.append([index, index + 1])
+    return ranges
+
+
+def _build_summary(build):
+    causes = []
+    for action in build['actions']:
+        action_causes = action.get('causes')
+        if not action_causes:
+            continue
+        for cause in action_causes:
+            description = cause.get('shortDescription')
+            if not description:
+                continue
+            causes.append(description)
+    return {
+        'number': build['number'],
+        'result': build['result'],
+        'cause': ', '.join(causes),
+        'timestamp': build['timestamp'],
+        'building': build['building']
+    }
@@ -14,25 +14,76 @@
 # limitations under the License.
 ############
 
+import os
 import sys
 from StringIO import StringIO
 
 import argh
 
 from je import commands
+from je.timings import timings
 
 
 def main():
+    _enable_timings()
     parser = argh.ArghParser()
+    # Only listed for --help, see _enable_timings
+    parser.add_argument('--timings', action='store_true',
+                        help='Print timings of HTTP requests, cache loads, '
+                             'known errors matching and report file writes '
+                             '(also enabled by JE_PROFILE)')
+    parser.add_argument('--timings-file', metavar='PATH',
+                        help='Write the timings as JSON to this file (also '
+                             'set by JE_PROFILE_FILE)')
     subparsers_action = argh.utils.get_subparsers(parser, create=True)
     subparsers_action.metavar = ''
     parser.add_commands(commands.app.commands)
+    parser.add_commands(commands.cache_app.commands,
+                        namespace='cache',
+                        namespace_kwargs={'help': 'Inspect and prune the '
+                                                  'local cache'})
     errors = StringIO()
-    parser.dispatch(errors_file=errors)
+    try:
+        parser.dispatch(errors_file=errors)
+    finally:
+        if os.environ.get('JE_POOL_STATS'):
+            _print_pool_stats()
+        if timings.enabled:
+            timings.summary()
+            if timings.trace_file:
+                timings.write_trace()
     errors_value = errors.getvalue()
     if errors_value:
         errors_value = errors_value.replace('CommandError', 'error').strip()
         sys.exit(errors_value)
 
+
+def _enable_timings():
+    # --timings and --timings-file apply to all commands, so they are taken
+    # out of the arguments before they are parsed
+    enabled = bool(os.environ.get('JE_PROFILE'))
+    trace_file = os.environ.get('JE_PROFILE_FILE')
+    args = []
+    argv = iter(sys.argv[1:])
+    for arg in argv:
+        if arg == '--timings':
+            enabled = True
+        elif arg == '--timings-file':
+            trace_file = next(argv, None)
+        elif arg.startswith('--timings-file='):
+            trace_file = arg.split('=', 1)[1]
+        else:
+            args.append(arg)
+    sys.argv[1:] = args
+    if enabled or trace_file:
+        timings.enable(trace_file)
+
+
+def _print_pool_stats():
+    from je.jenkins import jenkins
+    for stats in jenkins.pool_stats():
+        sys.stderr.write('{host}: {requests} requests over {connections} '
+                         'connections ({idle} idle)\n'.format(**stats))
+
 if __name__ == '__main__':
     main()
@@ -0,0 +1,374 @@
+########
+# Copyright (c) 2016 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+############
+
+import sqlite3
+import threading
+
+from je.cache import cache
+
+
+# Bump when the schema changes, to rebuild the index from the cache
+SCHEMA_VERSION = 2
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS builds (
+    job TEXT NOT NULL,
+    build INTEGER NOT NULL,
+    state TEXT NOT NULL,
+    PRIMARY KEY (job, build)
+);
+CREATE TABLE IF NOT EXISTS cases (
+    id INTEGER PRIMARY KEY,
+    job TEXT NOT NULL,
+    suite TEXT NOT NULL,
+    name TEXT NOT NULL,
+    UNIQUE (job, suite, name)
+);
+CREATE TABLE IF NOT EXISTS results (
+    job TEXT NOT NULL,
+    build INTEGER NOT NULL,
+    case_id INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    duration REAL
+);
+CREATE INDEX IF NOT EXISTS results_build ON results (job, build);
+CREATE INDEX IF NOT EXISTS results_case ON results (case_id, build);
+CREATE TABLE IF NOT EXISTS aggregates (
+    job TEXT NOT NULL,
+    case_id INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (job, case_id, status)
+);
+CREATE TABLE IF NOT EXISTS aggregated_builds (
+    job TEXT NOT NULL,
+    build INTEGER NOT NULL,
+    PRIMARY KEY (job, build)
+);
+'''
+
+DROP_SCHEMA = '''
+DROP TABLE IF EXISTS builds;
+DROP TABLE IF EXISTS cases;
+DROP TABLE IF EXISTS results;
+DROP TABLE IF EXISTS aggregates;
+DROP TABLE IF EXISTS aggregated_builds;
+'''
+
+# Build states
+OK = 'ok'
+NO_REPORT = 'no_report'
+
+# Status codes, ordered so that a failure of any of the runs of a case in
+# a build (e.g. of a parameterized case) takes precedence
+NOT_RUN = 0
+SKIPPED_CODE = 1
+PASSED_CODE = 2
+FAILED_CODE = 3
+
+
+def case_name(case):
+    """Return the display name of a test case: its class name (without the
+    package) followed by the case name, without parameters"""
+    name = case['name'].split('@')[0].strip()
+    class_name = (case['className'] or '').split('.')[-1].strip()
+    if class_name:
+        name = '{}.{}'.format(class_name, name)
+    return name
+
+
+def case_status(case):
+    """Return the status of a test case, folding REGRESSION into FAILED and
+    FIXED into PASSED"""
+    status = case['status']
+    if status in ['FAILED', 'REGRESSION']:
+        return 'FAILED'
+    elif status in ['PASSED', 'FIXED']:
+        return 'PASSED'
+    return status
+
+
+class CaseCounts(object):
+    """Pass, fail and skip counts of a single test case"""
+
+    __slots__ = ('passed', 'failed', 'skipped')
+
+    def __init__(self):
+        self.passed = 0
+        self.failed = 0
+        self.skipped = 0
+
+    def add(self, status, count):
+        if status == 'PASSED':
+            self.passed += count
+        elif status == 'FAILED':
+            self.failed += count
+        elif status == 'SKIPPED':
+            self.skipped += count
+
+
+class Results(object):
+    """SQLite index of test case results, one row per (job, build, case),
+    for fast queries across many builds. Suite and case names are stored
+    once per job in `cases`, and referenced by id.
+
+    Only finished builds are indexed. Builds are indexed when fetched from
+    Jenkins, and builds that were cached before the index existed are
+    indexed the first time a query needs them.
+
+    Status counts are materialized per job (`aggregates`) for the set of
+    builds they were last computed for (`aggregated_builds`). A query over
+    another set of builds only folds in the added builds and subtracts the
+    removed ones.
+    """
+
+    def __init__(self):
+        self._connection = None
+        self._lock = threading.RLock()
+        self._case_ids = {}
+
+    def reset(self):
+        """Drop the connection and cached case ids, e.g. in a forked
+        process, so the connection is not shared with the parent process
+        """
+        with self._lock:
+            self._connection = None
+            self._case_ids = {}
+
+    @property
+    def db_path(self):
+        return cache.cache_dir / 'results.db'
+
+    @property
+    def connection(self):
+        with self._lock:
+            if self._connection is None:
+                self.db_path.dirname().mkdir_p()
+                connection = sqlite3.connect(self.db_path,
+                                             check_same_thread=False)
+                version = connection.execute(
+                    'PRAGMA user_version').fetchone()[0]
+                if version != SCHEMA_VERSION:
+                    # Indexed builds are re-indexed from the cache when
+                    # queries need them
+                    connection.executescript(DROP_SCHEMA)
+                connection.executescript(SCHEMA)
+                connection.execute('PRAGMA user_version = {}'.format(
+                    SCHEMA_VERSION))
+                self._connection = connection
+            return self._connection
+
+    def index_build(self, job, build, fetched_build):
+        """Index the test report of a fetched build
+
+        :param fetched_build: A build as returned by `Jenkins.fetch_build`
+        """
+        if fetched_build['build'].get('building'):
+            return
+        build = int(build)
+        test_report = fetched_build['test_report']
+        state = NO_REPORT if test_report.get('status') == 'error' else OK
+        with self._lock:
+            try:
+                self._index_build(job, build, test_report, state)
+            except BaseException:
+                # Case ids added by the rolled back transaction are gone
+                self._case_ids.pop(job, None)
+                raise
+
+    def _index_build(self, job, build, test_report, state):
+        with self.connection as connection:
+            # Only this build's rows are held in memory, with the suites
+            # of its report streamed from the cache
+            rows = []
+            for suite in test_report.get('suites', []):
+                suite_name = suite['name']
+                for case in suite['cases']:
+                    case_id = self._case_id(job, suite_name,
+                                            case_name(case))
+                    rows.append((job, build, case_id, case_status(case),
+                                 case.get('duration')))
+            self._unaggregate_build(job, build)
+            connection.execute(
+                'DELETE FROM results WHERE job = ? AND build = ?',
+                (job, build))
+            connection.executemany(
+                'INSERT INTO results VALUES (?, ?, ?, ?, ?)', rows)
+            connection.execute(
+                'INSERT OR REPLACE INTO builds VALUES (?, ?, ?)',
+                (job, build, state))
+
+    def build_states(self, job, builds):
+        """Return a dict of build number to state for all indexed builds
+        out of `builds`"""
+        with self._lock:
+            self._set_requested_builds(builds)
+            cursor = self.connection.execute(
+                'SELECT b.build, b.state FROM builds b '
+                'JOIN requested_builds r ON b.build = r.build '
+                'WHERE b.job = ?', (job,))
+            result = {str(build): state for build, state in cursor}
+            self.connection.commit()
+            return result
+
+    def status_counts(self, job, builds):
+        """Return (suite, case, status, count) rows for the cases of all
+        indexed `builds` of `job`, ordered by suite, case and status"""
+        with self._lock:
+            with self.connection as connection:
+                self._set_requested_builds(builds)
+                connection.execute('CREATE TEMP TABLE IF NOT EXISTS '
+                                   'changed_builds (build INTEGER PRIMARY '
+                                   'KEY, sign INTEGER NOT NULL)')
+                connection.execute('DELETE FROM changed_builds')
+                connection.execute(
+                    'INSERT INTO changed_builds '
+                    'SELECT build, 1 FROM requested_builds '
+                    'WHERE build NOT IN (SELECT build FROM aggregated_builds '
+                    '                    WHERE job = ?)', (job,))
+                connection.execute(
+                    'INSERT INTO changed_builds '
+                    'SELECT build, -1 FROM aggregated_builds '
+                    'WHERE job = ? AND '
+                    '      build NOT IN (SELECT build FROM requested_builds)',
+                    (job,))
+                deltas = connection.execute(
+                    'SELECT case_id, status, SUM(sign) FROM results '
+                    'JOIN changed_builds USING (build) '
+                    'WHERE job = ? '
+                    'GROUP BY case_id, status', (job,)).fetchall()
+                self._apply_deltas(job, deltas)
+                connection.execute(
+                    'DELETE FROM aggregated_builds WHERE job = ? AND build IN '
+                    '(SELECT build FROM changed_builds WHERE sign < 0)',
+                    (job,))
+                connection.execute(
+                    'INSERT INTO aggregated_builds '
+                    'SELECT ?, build FROM changed_builds WHERE sign > 0',
+                    (job,))
+                return connection.execute(
+                    'SELECT c.suite, c.name, a.status, a.count '
+                    'FROM aggregates a JOIN cases c ON a.case_id = c.id '
+                    'WHERE a.job = ? '
+                    'ORDER BY c.suite, c.name, a.status', (job,)).fetchall()
+
+    def case_history(self, job, name, suite=None):
+        """Return (build, suite, status, duration) rows of all indexed runs
+        of a case, ordered by build
+
+        :param suite: Only return runs of the case in this suite. Cases
+                      with the same name may run in several suites.
+        """
+        query = ('SELECT r.build, c.suite, r.status, r.duration '
+                 'FROM results r JOIN cases c ON r.case_id = c.id '
+                 'WHERE c.job = ? AND c.name = ? ')
+        parameters = [job, name]
+        if suite is not None:
+            query += 'AND c.suite = ? '
+            parameters.append(suite)
+        with self._lock:
+            return self.connection.execute(
+                query + 'ORDER BY r.build, c.suite', parameters).fetchall()
+
+    def job_cases(self, job):
+        """Return (case id, suite, case) rows of all the indexed cases of
+        `job`, ordered by suite and case"""
+        with self._lock:
+            return self.connection.execute(
+                'SELECT id, suite, name FROM cases WHERE job = ? '
+                'ORDER BY suite, name', (job,)).fetchall()
+
+    def status_codes(self, job, builds, chunk_size=10000):
+        """Yield lists of up to `chunk_size` (build, case id, status code)
+        rows for the cases of all indexed `builds` of `job`"""
+        with self._lock:
+            self._set_requested_builds(builds)
+            cursor = self.connection.execute(
+                'SELECT r.build, r.case_id, '
+                '       CASE r.status WHEN ? THEN ? WHEN ? THEN ? '
+                '                     WHEN ? THEN ? ELSE ? END '
+                'FROM results r JOIN requested_builds USING (build) '
+                'WHERE r.job = ?',
+                ('SKIPPED', SKIPPED_CODE, 'PASSED', PASSED_CODE,
+                 'FAILED', FAILED_CODE, NOT_RUN, job))
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield rows
+            self.connection.commit()
+
+    def _unaggregate_build(self, job, build):
+        # A re-indexed build is subtracted from the aggregates, and is
+        # folded in again by the next query that includes it
+        connection = self.connection
+        if not connection.execute(
+                'DELETE FROM aggregated_builds WHERE job = ? AND build = ?',
+                (job, build)).rowcount:
+            return
+        deltas = connection.execute(
+            'SELECT case_id, status, -COUNT(*) FROM results '
+            'WHERE job = ? AND build = ? '
+            'GROUP BY case_id, status', (job, build)).fetchall()
+        self._apply_deltas(job, deltas)
+
+    def _apply_deltas(self, job, deltas):
+        """Add (case id, status, delta) rows to the aggregates of `job`"""
+        connection = self.connection
+        connection.executemany(
+            'INSERT OR IGNORE INTO aggregates VALUES (?, ?, ?, 0)',
+            [(job, case_id, status) for case_id, status, _ in deltas])
+        connection.executemany(
+            'UPDATE aggregates SET count = count + ? '
+            'WHERE job = ? AND case_id = ? AND status = ?',
+            [(delta, job, case_id, status)
+             for case_id, status, delta in deltas])
+        connection.execute('DELETE FROM aggregates '
+                           'WHERE job = ? AND count = 0', (job,))
+
+    def _case_id(self, job, suite_name, name):
+        """Return the id of a case, adding it to `cases` if it is new. Ids
+        of a job are loaded once, and kept in memory"""
+        case_ids = self._case_ids.get(job)
+        if case_ids is None:
+            case_ids = self._case_ids[job] = {
+                (suite, case): case_id for case_id, suite, case in
+                self.connection.execute(
+                    'SELECT id, suite, name FROM cases WHERE job = ?',
+                    (job,))}
+        key = (suite_name, name)
+        case_id = case_ids.get(key)
+        if case_id is None:
+            # Another je process may have added it since ids were loaded
+            self.connection.execute(
+                'INSERT OR IGNORE INTO cases (job, suite, name) '
+                'VALUES (?, ?, ?)', (job, suite_name, name))
+            case_id = case_ids[key] = self.connection.execute(
+                'SELECT id FROM cases WHERE job = ? AND suite = ? AND '
+                'name = ?', (job, suite_name, name)).fetchone()[0]
+        return case_id
+
+    def _set_requested_builds(self, builds):
+        # Build lists can be longer than the number of allowed query
+        # parameters, so they are joined through a temporary table
+        connection = self.connection
+        connection.execute('CREATE TEMP TABLE IF NOT EXISTS requested_builds '
+                           '(build INTEGER PRIMARY KEY)')
+        connection.execute('DELETE FROM requested_builds')
+        connection.executemany('INSERT OR IGNORE INTO requested_builds '
+                               'VALUES (?)',
+                               [(int(b),) for b in builds])
+results = Results()
@@ -0,0 +1,113 @@
+########
+# Copyright (c) 2016 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+############
+
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+from je.configuration import configuration
+
+
+RETRY_STATUSES = (500, 502, 503, 504)
+
+
+class Session(object):
+    """A process wide, connection pooled HTTP session.
+
+    All HTTP traffic should go through here so connections (and their TLS
+    handshakes) are reused between requests.
+    """
+
+    def __init__(self):
+        self._session = None
+        self._lock = threading.Lock()
+
+    @property
+    def session(self):
+        with self._lock:
+            if self._session is None:
+                self._session = self._create_session()
+            return self._session
+
+    def reset(self):
+        """Drop the session and its pooled connections, e.g. in a forked
+        process, so connections are not shared with the parent process
+        """
+        with self._lock:
+            self._session = None
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', (configuration.http_connect_timeout,
+                                      configuration.http_read_timeout))
+        return self.session.request(method, url, **kwargs)
+
+    def stats(self):
+        """Return per host pool statistics.
+
+        ``connections`` is the number of connections that were opened and
+        ``requests`` is the number of requests sent over them, so a
+        ``requests`` count higher than ``connections`` means connections
+        are being reused.
+        """
+        if self._session is None:
+            return []
+        result = []
+        for adapter in set(self._session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool is None:
+                    continue
+                result.append({
+                    'host': '{}://{}:{}'.format(pool.scheme,
+                                                pool.host,
+                                                pool.port),
+                    'connections': pool.num_connections,
+                    'requests': pool.num_requests,
+                    'idle': self._idle_connections(pool)
+                })
+        return result
+
+    @staticmethod
+    def _idle_connections(pool):
+        # The pool queue is filled with None placeholders up to its
+        # maxsize, only actual connections in it are idle
+        if not pool.pool:
+            return 0
+        with pool.pool.mutex:
+            return sum(1 for connection in pool.pool.queue
+                       if connection is not None)
+
+    @staticmethod
+    def _create_session():
+        pool_size = configuration.http_pool_size
+        retries = Retry(total=configuration.http_retries,
+                        backoff_factor=configuration.http_backoff_factor,
+                        status_forcelist=RETRY_STATUSES)
+        adapter = HTTPAdapter(pool_connections=pool_size,
+                              pool_maxsize=pool_size,
+                              max_retries=retries)
+        result = requests.Session()
+        result.mount('http://', adapter)
+        result.mount('https://', adapter)
+        result.headers.update({
+            'Accept-Encoding': 'gzip, deflate',
+            'Connection': 'keep-alive'
+        })
+        return result
+session = Session()
@@ -0,0 +1,125 @@
+########
+# Copyright (c) 2016 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+############
+
+"""Flakiness statistics of test cases across builds.
+
+Statistics are computed on a builds x cases matrix of status codes (see
+`je.results`), with vectorized operations. Requires the optional `numpy`
+package.
+"""
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from je.results import results, NOT_RUN, PASSED_CODE, FAILED_CODE
+
+
+def status_matrix(job, builds):
+    """Return the status matrix of the indexed `builds` of `job`
+
+    :return: A (build numbers, cases, matrix) tuple. Build numbers are
+             sorted, cases are (suite, case) pairs of the cases that ran in
+             any of the builds, and matrix[i, j] is the status code of case
+             j in build i
+    """
+    build_numbers = numpy.array(sorted(int(b) for b in builds),
+                                dtype=numpy.int64)
+    cases = results.job_cases(job)
+    case_ids = numpy.array([case[0] for case in cases], dtype=numpy.int64)
+    columns = numpy.zeros(case_ids.max() + 1 if len(cases) else 0,
+                          dtype=numpy.int64)
+    columns[case_ids] = numpy.arange(len(cases))
+    matrix = numpy.zeros((len(build_numbers), len(cases)), dtype=numpy.int8)
+    for rows in results.status_codes(job, build_numbers.tolist()):
+        rows = numpy.array(rows, dtype=numpy.int64)
+        numpy.maximum.at(matrix,
+                         (numpy.searchsorted(build_numbers, rows[:, 0]),
+                          columns[rows[:, 1]]),
+                         rows[:, 2].astype(numpy.int8))
+    ran = (matrix != NOT_RUN).any(axis=0)
+    return (build_numbers,
+            [cases[j][1:] for j in numpy.flatnonzero(ran)],
+            matrix[:, ran])
+
+
+def case_stats(build_numbers, matrix):
+    """Compute the statistics of every case (column) of a status matrix
+
+    Builds a case did not run in are ignored, so e.g. a case that failed,
+    did not run and failed again has a failing streak of 2. Flips and
+    regressions only consider runs that passed or failed.
+
+    :return: A dict of arrays with an item per case:
+             runs: Builds the case ran in
+             failures: Builds the case failed in
+             flake_rate: Pass/fail flips between consecutive runs, out of
+                         all pairs of consecutive runs
+             longest_streak: Longest run of consecutive failures
+             first_regression: First build that failed right after a
+                               passing run, 0 if none
+             changes: Status changes between consecutive runs
+    """
+    rows = numpy.arange(matrix.shape[0])[:, None]
+    columns = numpy.arange(matrix.shape[1])
+    ran = matrix != NOT_RUN
+    failed = matrix == FAILED_CODE
+
+    # Status of the previous run of each case, for every build
+    previous = _previous_runs(matrix, ran, rows, columns)
+    compared = ran[1:] & (previous != NOT_RUN)
+    changes = (compared & (matrix[1:] != previous)).sum(axis=0)
+
+    passed_or_failed = failed | (matrix == PASSED_CODE)
+    previous = _previous_runs(matrix, passed_or_failed, rows, columns)
+    compared = passed_or_failed[1:] & \
+        ((previous == PASSED_CODE) | (previous == FAILED_CODE))
+    flips = compared & (matrix[1:] != previous)
+    flake_rate = flips.sum(axis=0) / \
+        numpy.maximum(compared.sum(axis=0), 1).astype(numpy.float64)
+    regressions = flips & failed[1:]
+    first_regression = numpy.where(
+        regressions.any(axis=0),
+        build_numbers[1:][regressions.argmax(axis=0)]
+        if len(regressions) else 0,
+        0)
+
+    # Failures so far, minus failures so far at the last run that did not
+    # fail, is the length of the current failing streak
+    failures = numpy.cumsum(failed, axis=0, dtype=numpy.int32)
+    resets = numpy.where(ran & ~failed, failures, 0)
+    streaks = failures - numpy.maximum.accumulate(resets, axis=0)
+
+    return {
+        'runs': ran.sum(axis=0),
+        'failures': failed.sum(axis=0),
+        'flake_rate': flake_rate,
+        'longest_streak': streaks.max(axis=0) if len(streaks) else
+        numpy.zeros(len(columns), dtype=numpy.int32),
+        'first_regression': first_regression,
+        'changes': changes
+    }
+
+
+def _previous_runs(matrix, ran, rows, columns):
+    """Return a matrix with a row less than `matrix`, whose row i is the
+    status of the last run (as marked by `ran`) of each case up to and
+    including build i, or NOT_RUN"""
+    last_run = numpy.maximum.accumulate(numpy.where(ran, rows, -1), axis=0)
+    previous = matrix[last_run[:-1], columns]
+    previous[last_run[:-1] < 0] = NOT_RUN
+    return previous
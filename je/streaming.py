@@ -0,0 +1,122 @@
+########
+# Copyright (c) 2016 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+############
+
+"""Incremental (de)serialization of test reports.
+
+A test report is parsed one suite at a time, so only a single suite is
+held in memory at any given time. Suites are the smallest unit: the cases
+of a suite are all parsed before it is yielded, as reports are rendered
+suite by suite and go over a suite's cases more than once. Memory use is
+thus bounded by the largest suite rather than by the whole report.
+
+Incremental parsing requires the optional `ijson` package. Without it
+reports are parsed as a whole, as before.
+"""
+
+import decimal
+import json
+
+try:
+    from ijson.common import ObjectBuilder
+    try:
+        import ijson.backends.yajl2_c as ijson
+    except ImportError:
+        import ijson
+except ImportError:
+    ijson = None
+
+
+SUITES_PREFIX = 'suites.item'
+CONTAINER_EVENTS = ('start_map', 'end_map', 'start_array', 'end_array',
+                    'map_key')
+
+
+def iter_suites(fileobj, attributes):
+    """Yield the suites of a JSON test report read from `fileobj`, each
+    parsed as a whole
+
+    :param fileobj: A file like object to read the report from
+    :param attributes: A dict that top level scalar values of the report
+                       (e.g. `status`) are added to, as they are read
+    """
+    if ijson is None:
+        report = json.load(fileobj)
+        suites = report.pop('suites', [])
+        attributes.update(report)
+        for suite in suites:
+            yield suite
+        return
+    builder = None
+    for prefix, event, value in ijson.parse(fileobj):
+        if isinstance(value, decimal.Decimal):
+            value = float(value)
+        if builder is None and prefix == SUITES_PREFIX and \
+                event == 'start_map':
+            builder = ObjectBuilder()
+        if builder is not None:
+            builder.event(event, value)
+            if prefix == SUITES_PREFIX and event == 'end_map':
+                yield builder.value
+                builder = None
+        elif prefix and '.' not in prefix and \
+                event not in CONTAINER_EVENTS:
+            attributes[prefix] = value
+
+
+def dump_report(suites, attributes):
+    """Yield the JSON serialization of a test report, in chunks
+
+    :param suites: An iterable of the report's suites
+    :param attributes: The report's top level scalar values. It is only read
+                       after `suites` has been exhausted, so it can be the
+                       dict filled by `iter_suites`
+    """
+    yield '{"suites":['
+    for index, suite in enumerate(suites):
+        if index:
+            yield ','
+        yield json.dumps(suite, separators=(',', ':'))
+    yield ']'
+    for key, value in sorted(attributes.items()):
+        yield ',{}:{}'.format(json.dumps(key), json.dumps(value))
+    yield '}'
+
+
+def load_report(fileobj):
+    """Load a test report whose `suites` are read lazily from `fileobj`
+
+    The report's top level values are available right away. `suites` is
+    an iterator that may only be consumed once. `fileobj` is closed once it
+    has been consumed.
+    """
+    attributes = {}
+    suites = iter_suites(fileobj, attributes)
+    first = next(suites, None)
+    if first is None:
+        fileobj.close()
+        attributes.setdefault('suites', [])
+    else:
+        attributes['suites'] = _chain_suites(first, suites, fileobj)
+    return attributes
+
+
+def _chain_suites(first, suites, fileobj):
+    try:
+        yield first
+        for suite in suites:
+            yield suite
+    finally:
+        fileobj.close()
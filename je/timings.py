@@ -0,0 +1,152 @@
+########
+# Copyright (c) 2016 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+############
+
+import contextlib
+import json
+import os
+import socket
+import sys
+import threading
+import time
+
+
+# Phases
+HTTP = 'http'
+CACHE_LOAD = 'cache load'
+KNOWN_ERRORS = 'known errors'
+REPORT_FILES = 'report files'
+
+# Counters
+CACHE_HITS = 'cache hits'
+CACHE_MISSES = 'cache misses'
+
+SLOWEST_REQUESTS = 5
+
+
+class Timings(object):
+    """Collects timings of the phases of a command (HTTP requests, cache
+    loads, known errors matching, report file writes) when enabled with
+    --timings or JE_PROFILE.
+
+    Phases may overlap (e.g. HTTP requests made while rendering a report),
+    and phases of concurrent threads are all added up, so phase totals
+    can exceed the wall time. When disabled, timing calls do nothing.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.trace_file = None
+        self._lock = threading.Lock()
+        self._start = time.time()
+        self._phases = {}
+        self._counters = {}
+        self._requests = []
+
+    def enable(self, trace_file=None):
+        self.enabled = True
+        self.trace_file = trace_file
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        if not self.enabled:
+            yield
+            return
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, time.time() - start)
+
+    def add(self, name, duration):
+        if not self.enabled:
+            return
+        with self._lock:
+            phase = self._phases.setdefault(name, {'count': 0, 'time': 0.0})
+            phase['count'] += 1
+            phase['time'] += duration
+
+    def count(self, name, amount=1):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + amount
+
+    def request(self, method, url, status, size, latency):
+        """Record an HTTP request
+
+        :param size: Response body size in bytes, None if unknown (e.g. a
+                     streamed response without a Content-Length)
+        :param latency: Seconds until the response was received (until its
+                        headers, for streamed responses)
+        """
+        if not self.enabled:
+            return
+        self.add(HTTP, latency)
+        with self._lock:
+            self._requests.append({
+                'method': method,
+                'url': url,
+                'status': status,
+                'bytes': size,
+                'latency': latency,
+                'time': time.time() - self._start
+            })
+
+    def summary(self, stream=None):
+        stream = stream or sys.stderr
+        with self._lock:
+            phases = dict(self._phases)
+            counters = dict(self._counters)
+            requests = list(self._requests)
+        stream.write('Timings (wall time {:.3f}s):\n'.format(
+            time.time() - self._start))
+        for name, phase in sorted(phases.items(),
+                                  key=lambda item: item[1]['time'],
+                                  reverse=True):
+            stream.write('  {:<16}{:>8.3f}s {:>8} calls\n'.format(
+                name, phase['time'], phase['count']))
+        if requests:
+            size = sum(request['bytes'] or 0 for request in requests)
+            stream.write('Slowest of {} requests ({} bytes):\n'.format(
+                len(requests), size))
+            for request in sorted(requests,
+                                  key=lambda request: request['latency'],
+                                  reverse=True)[:SLOWEST_REQUESTS]:
+                stream.write('  {:>8.3f}s {} {} {}\n'.format(
+                    request['latency'], request['status'],
+                    request['method'], request['url']))
+        if counters:
+            stream.write('Counters:\n')
+            for name, value in sorted(counters.items()):
+                stream.write('  {:<16}{:>8}\n'.format(name, value))
+
+    def write_trace(self, trace_file=None):
+        """Write all timings as JSON, for collecting them across runs"""
+        trace_file = trace_file or self.trace_file
+        with self._lock:
+            trace = {
+                'argv': sys.argv,
+                'host': socket.gethostname(),
+                'pid': os.getpid(),
+                'start': self._start,
+                'wall_time': time.time() - self._start,
+                'phases': self._phases,
+                'counters': self._counters,
+                'requests': self._requests
+            }
+            with open(trace_file, 'w') as f:
+                json.dump(trace, f, indent=2)
+timings = Timings()
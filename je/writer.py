@@ -0,0 +1,218 @@
+########
+# Copyright (c) 2016 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+############
+
+import hashlib
+import json
+import os
+import threading
+from Queue import Queue
+
+from je.timings import timings, REPORT_FILES
+
+
+# Report directory layouts
+# cases: passed/<case>.log and failed/<case>.log, a file per case
+CASES = 'cases'
+# suites: suites/<suite>.log with all the cases of a suite, and
+# suites/<suite>.index.json mapping case file names to their status and
+# (offset, length) in <suite>.log
+SUITES = 'suites'
+LAYOUTS = [CASES, SUITES]
+
+MANIFEST = 'manifest.json'
+# Bump when the content of report files changes, to rewrite all reports
+MANIFEST_VERSION = 1
+
+_QUEUE_SIZE = 1024
+_CLOSE = object()
+
+
+def load_manifest(build_dir):
+    manifest_path = build_dir / MANIFEST
+    try:
+        manifest = json.loads(manifest_path.text())
+    except (IOError, OSError, ValueError):
+        return None
+    if manifest.get('version') != MANIFEST_VERSION:
+        return None
+    return manifest
+
+
+def is_up_to_date(build_dir, report_hash, layout):
+    """Whether the report files of a build were written from the same
+    report (and known errors), in the same layout"""
+    manifest = load_manifest(build_dir)
+    return manifest is not None and \
+        manifest['report_hash'] == report_hash and \
+        manifest['layout'] == layout
+
+
+class ReportWriter(object):
+    """Writes the report files of a build from a background thread
+
+    Files whose content did not change since the previous manifest are not
+    rewritten, and files that are no longer part of the report are removed.
+    The manifest is written last, on `close()`, so an interrupted report is
+    fully rewritten by the next run.
+    """
+
+    def __init__(self, build_dir, report_hash, layout=CASES):
+        self._build_dir = build_dir
+        self._report_hash = report_hash
+        self._layout = layout
+        self._previous = load_manifest(build_dir)
+        self._files = {}
+        # Suites layout: the index of each suite written so far, and the
+        # data file of the suite being written
+        self._suites = {}
+        self._suite_name = None
+        self._suite_file = None
+        self._error = None
+        (build_dir / MANIFEST).remove_p()
+        if self._previous is None:
+            # Written before manifests existed, or interrupted
+            for name in ['passed', 'failed', 'suites']:
+                (build_dir / name).rmtree_p()
+        if layout == CASES:
+            for name in ['passed', 'failed']:
+                (build_dir / name).mkdir_p()
+        else:
+            (build_dir / 'suites').mkdir_p()
+        self._queue = Queue(_QUEUE_SIZE)
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def add(self, suite_name, status_dir, filename, content):
+        """Queue a case file to be written
+
+        :param status_dir: 'passed' or 'failed'
+        """
+        if self._error is not None:
+            raise self._error
+        self._queue.put((suite_name, status_dir, filename, content))
+
+    def close(self):
+        self._queue.put(_CLOSE)
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+        self._finish_suite()
+        self._remove_stale_files()
+        manifest_path = self._build_dir / MANIFEST
+        manifest_path.write_text(json.dumps({
+            'version': MANIFEST_VERSION,
+            'report_hash': self._report_hash,
+            'layout': self._layout,
+            'files': self._files
+        }))
+
+    def abort(self):
+        """Stop writing, without writing a manifest"""
+        self._queue.put(_CLOSE)
+        self._thread.join()
+        if self._suite_file is not None:
+            self._suite_file.close()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is _CLOSE:
+                return
+            if self._error is not None:
+                # Keep draining so add() never blocks
+                continue
+            try:
+                self._write_case(*item)
+            except Exception as e:
+                self._error = e
+
+    def _write_case(self, suite_name, status_dir, filename, content):
+        if self._layout == SUITES:
+            self._write_suite_case(suite_name, status_dir, filename, content)
+            return
+        relative_path = '{}/{}'.format(status_dir, filename)
+        digest = hashlib.md5(content).hexdigest()
+        self._files[relative_path] = digest
+        previous_files = self._previous['files'] if self._previous else {}
+        target = self._build_dir / relative_path
+        if previous_files.get(relative_path) == digest and target.isfile():
+            return
+        with timings.phase(REPORT_FILES):
+            with open(target, 'wb') as f:
+                f.write(content)
+
+    def _write_suite_case(self, suite_name, status_dir, filename, content):
+        # Cases arrive a suite after the other, each case is written through
+        # to its suite's data file, and the suite's index is written once
+        # the next suite starts
+        if suite_name != self._suite_name:
+            self._finish_suite()
+            self._start_suite(suite_name)
+        suite = self._suites[suite_name]
+        with timings.phase(REPORT_FILES):
+            self._suite_file.write(content)
+        suite['digest'].update(content)
+        suite['index'][filename] = {'status': status_dir,
+                                    'offset': suite['offset'],
+                                    'length': len(content)}
+        suite['offset'] += len(content)
+
+    def _start_suite(self, suite_name):
+        name = suite_name.replace('/', '-').replace(' ', '-')
+        suite = self._suites.get(suite_name)
+        if suite is None:
+            suite = self._suites[suite_name] = {
+                'data_path': 'suites/{}.log'.format(name),
+                'index_path': 'suites/{}.index.json'.format(name),
+                'index': {},
+                'offset': 0,
+                'digest': hashlib.md5()
+            }
+            mode = 'wb'
+        else:
+            # A suite name that appears more than once in the report
+            mode = 'ab'
+        self._suite_name = suite_name
+        self._suite_file = open(self._build_dir / suite['data_path'], mode)
+
+    def _finish_suite(self):
+        if self._suite_file is None:
+            return
+        suite = self._suites[self._suite_name]
+        with timings.phase(REPORT_FILES):
+            self._suite_file.close()
+            (self._build_dir / suite['index_path']).write_text(
+                json.dumps(suite['index']))
+        self._files[suite['data_path']] = suite['digest'].hexdigest()
+        self._files[suite['index_path']] = None
+        self._suite_name = None
+        self._suite_file = None
+
+    def _remove_stale_files(self):
+        if not self._previous:
+            return
+        for relative_path in self._previous['files']:
+            if relative_path not in self._files:
+                try:
+                    os.remove(self._build_dir / relative_path)
+                except OSError:
+                    pass
+        if self._layout == SUITES:
+            for name in ['passed', 'failed']:
+                (self._build_dir / name).rmtree_p()
+        else:
+            (self._build_dir / 'suites').rmtree_p()
@@ -33,6 +33,10 @@ setup(
         'argh',
         'pyyaml'
     ],
+    extras_require={
+        'streaming': ['ijson'],
+        'stats': ['numpy']
+    },
     entry_points={
         'console_scripts': [
             'je = je.main:main',